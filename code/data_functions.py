@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for reading the input data of finding_distances.py: a columnar cache for the source files,
+the PC6/house number mapping files and the PC6 -> gemeente/wijk lookup index built from them, and an
+offline geocoder for addresses on top of these.
+"""
+
+
+#%% # Libraries
+import pandas as pd
+import numpy as np
+from pandas.api.types import union_categoricals
+# system
+import os
+import csv
+import glob
+import hashlib
+# geolocation
+import geopandas as gpd
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+#%% # Functions
+def find_all_filenames(path_to_dir, suffix=".xlsx", prefix=''):
+    filenames = os.listdir(path_to_dir)
+    return [ filename for filename in filenames if (filename.endswith(suffix)) & (filename.startswith(prefix)) ]
+
+def read_cached(reader, filename, cache_dir=None, refresh=False, **kwargs):
+    # read a source file through a columnar cache. The first read is stored as (Geo)Parquet in cache_dir/columnar
+    # under a key of the file path, modification time, size and reader arguments, so later runs skip the
+    # slow xls/csv/gpkg parsing. A changed source gives a new key, refresh=True forces a new read.
+    if cache_dir is None:
+        return reader(filename, **kwargs)
+    cachename = cache_prefix(cache_dir, filename) + files_key([filename], reader.__module__, reader.__name__, sorted(kwargs.items()))
+    if not refresh:
+        for suffix, read_cache in [('.parquet', pd.read_parquet), ('.geo.parquet', gpd.read_parquet), ('.pkl', pd.read_pickle)]:
+            if os.path.exists(cachename + suffix):
+                return read_cache(cachename + suffix)
+    clear_cache(cache_dir, filename)
+    df = reader(filename, **kwargs)
+    os.makedirs(os.path.join(cache_dir, 'columnar'), exist_ok=True)
+    suffix = '.geo.parquet' if isinstance(df, gpd.GeoDataFrame) else '.parquet'
+    try:
+        df.to_parquet(cachename + suffix)
+    except (ValueError, TypeError) as error: # e.g. numbers and '.' mixed in one column
+        if os.path.exists(cachename + suffix):
+            os.remove(cachename + suffix)
+        print('...Warning, no parquet cache for', os.path.basename(filename), '(%s), using pickle' % error)
+        df.to_pickle(cachename + '.pkl')
+    return df
+
+def files_key(filenames, *args):
+    # short hash of the path, modification time and size of the files, plus any extra arguments
+    stats = [(os.path.abspath(filename), os.stat(filename).st_mtime_ns, os.stat(filename).st_size) for filename in filenames]
+    return hashlib.md5(repr((stats, args)).encode()).hexdigest()[:12]
+
+def cache_prefix(cache_dir, filename):
+    # cache files of one source are in the subdirectory columnar (apart from the other files in cache_dir, e.g.
+    # the checkpoints and the geocode cache) and start with its name and a hash of its full path
+    path_id = hashlib.md5(os.path.abspath(filename).encode()).hexdigest()[:8]
+    return os.path.join(cache_dir, 'columnar', '%s_%s_' % (os.path.basename(filename), path_id))
+
+def clear_cache(cache_dir, filename=None):
+    # remove the cached versions of one source file, or of all files (only what read_cached wrote)
+    pattern = cache_prefix(cache_dir, filename) + '*' if filename else os.path.join(cache_dir, 'columnar', '*')
+    for cachename in glob.glob(pattern):
+        if os.path.isfile(cachename):
+            os.remove(cachename)
+
+def check_duplicates(df, cols_address=['Gemeente','Straatnaam','Postcode'], cols_coordinate=['Latitude','Longitude']):
+    # stembureaus to check once more (True): rows with a unique address and coordinate combination whose
+    # address or coordinate alone is shared with another row, i.e. same coordinate but different address
+    # or vice versa. Rows without a Postcode are skipped. Only the key columns are normalized (lowercase
+    # strings) and hashed, once per column; the groups are found on the combined 64-bit hashes.
+    keys = df.loc[df['Postcode'].notna(), cols_address + cols_coordinate]
+    hashes = pd.DataFrame({col: pd.util.hash_pandas_object(keys[col].astype(str).str.lower(), index=False) for col in keys.columns})
+    def unique(cols):
+        return ~pd.util.hash_pandas_object(hashes[cols], index=False).duplicated(keep=False).to_numpy()
+    unique_all = unique(cols_address + cols_coordinate)                 # same address & same coordinate
+    unique_both = unique(cols_coordinate) & unique(cols_address)        # different address & different coordinate
+    check = pd.Series(False, index=df.index)
+    check[keys.index] = unique_all ^ unique_both
+    return check
+
+def find_near_duplicates(df, radius=25, min_score=85, cols_xy=['X','Y'], cols_address=['Straatnaam','Huisnummer','Huisletter','Postcode']):
+    # near-duplicate stemlokalen: pairs within radius meters (RD-coordinates), found with a KD-tree, whose
+    # addresses are alike (rapidfuzz token_sort_ratio >= min_score), so only nearby pairs are compared.
+    # Linked pairs form clusters, ranked by their best score and then their smallest distance. Returns
+    # the rows in a cluster with 'cluster' (1 = most likely a duplicate), its size, score and distance.
+    from rapidfuzz import fuzz # only needed here
+    xy = df[cols_xy].to_numpy(dtype=float)
+    valid = np.flatnonzero(np.isfinite(xy).all(axis=1))
+    pairs = cKDTree(xy[valid]).query_pairs(r=radius, output_type='ndarray')
+    pairs = valid[pairs].reshape(-1, 2)
+    address = df[cols_address].fillna('').astype(str)
+    address = address.iloc[:, 0].str.cat([address[col] for col in cols_address[1:]], sep=' ').str.lower().str.split().str.join(' ').to_numpy()
+    scores = np.array([fuzz.token_sort_ratio(address[i], address[j]) for i, j in pairs], dtype=float)
+    distances = np.sqrt(((xy[pairs[:, 0]] - xy[pairs[:, 1]])**2).sum(axis=1))
+    linked = scores >= min_score
+    pairs, scores, distances = pairs[linked], scores[linked], distances[linked]
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(df), len(df)))
+    ncomponents, component = connected_components(graph, directed=False)
+    members = np.unique(pairs)
+    output = df.iloc[members][cols_address].copy()
+    output['component'] = component[members]
+    stats = pd.DataFrame({'component': component[pairs[:, 0]], 'cluster_score': scores, 'cluster_distance': distances})
+    stats = stats.groupby('component').agg({'cluster_score': 'max', 'cluster_distance': 'min'})
+    stats['cluster_size'] = output.groupby('component').size()
+    stats = stats.sort_values(by=['cluster_score','cluster_distance'], ascending=[False, True], kind='stable')
+    stats['cluster'] = np.arange(1, len(stats)+1)
+    output = output.join(stats, on='component').drop(columns='component')
+    return output.sort_values(by='cluster', kind='stable')[['cluster','cluster_size','cluster_score','cluster_distance'] + cols_address]
+
+def save_checkpoint(outputs, filename):
+    # outputs of a pipeline stage (a dict of frames, arrays, ...) in one file. Written under a temporary
+    # name first, so a run that breaks off never leaves a half checkpoint behind.
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    pd.to_pickle(outputs, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+def load_checkpoint(filename):
+    # the stored outputs of a pipeline stage, or None if there is no checkpoint
+    if not os.path.exists(filename):
+        return None
+    return pd.read_pickle(filename)
+
+def read_grid(filename, columns, chunksize=None):
+    # boxes of a CBS grid (vk500, vk100) without their polygons: the box id (first column), the given columns and
+    # the representative point X/Y of every box. With chunksize the file is read in parts of that many rows, so
+    # only one part of the polygons is in memory at a time.
+    return pd.concat(iter_grid(filename, columns, chunksize), ignore_index=True)
+
+def iter_grid(filename, columns, chunksize=None):
+    # the parts of read_grid one by one. The CBS grid files are stored in the order of the box ids, so a part
+    # is a band of neighbouring rows of boxes.
+    start = 0
+    while True:
+        chunk = gpd.read_file(filename, rows=slice(start, start + chunksize) if chunksize else None)
+        grid_chunk = pd.DataFrame(chunk[[chunk.columns[0]] + columns])
+        grid_chunk['X'], grid_chunk['Y'] = representative_xy(chunk.geometry)
+        grid_chunk.index += start
+        if len(grid_chunk) or not start: # no empty last part
+            yield grid_chunk
+        if (not chunksize) or (len(chunk) < chunksize):
+            break
+        start += chunksize
+
+def representative_xy(geometry):
+    # representative point of every polygon as X and Y arrays. For a rectangle (a grid box) this is its center,
+    # which is computed from the bounds; only other shapes go through representative_point().
+    bounds = geometry.bounds.to_numpy()
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    other = ~np.isclose(geometry.area.to_numpy(), (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1]))
+    if other.any():
+        points = geometry[other].representative_point()
+        x[other], y[other] = points.x.to_numpy(), points.y.to_numpy()
+    return x, y
+
+def merge_vintages(frames, keys, years=None, col_year=None):
+    # tables of several years (vintages) in priority order merged into one: every key (column or list of columns)
+    # gets the row of the first table that has it, in one concat and one hashed pass over the keys. With col_year the
+    # year of that table (from years, default the position in frames) is kept per row.
+    years = list(range(len(frames))) if years is None else list(years)
+    merged = pd.concat(frames, ignore_index=True)
+    first = ~merged.duplicated(subset=keys, keep='first').to_numpy()
+    merged = merged[first].reset_index(drop=True)
+    if col_year is not None:
+        merged[col_year] = np.repeat(years, [len(frame) for frame in frames])[first]
+    return merged
+
+def csv_delimiter(filename, delimiters=';,\t'):
+    # delimiter of a csv file, from its header line (the mapping files differ per year)
+    with open(filename, encoding='latin-1') as file:
+        return csv.Sniffer().sniff(file.readline(), delimiters=delimiters).delimiter
+
+def read_mapping_gwb(filenames, cols_rename, dtypes={'PC6':'category','Huisnummer':'int32','Wijkcode':'int32','Gemeentecode':'int32'},
+                     delimiter=None, **cachesettings):
+    # PC6/house number -> wijk/gemeente mapping of several years in one frame. Only the columns in dtypes are
+    # read (with those compact types, PC6 as codes of a categorical) and renamed per year; the delimiter is found
+    # per file unless given. The files are in priority order: for every (PC6, Huisnummer) the first file that has
+    # it wins, see merge_vintages.
+    mapgwb = []
+    for filename in filenames:
+        sep = csv_delimiter(filename) if delimiter is None else delimiter
+        header = pd.read_csv(filename, delimiter=sep, nrows=0).columns
+        usecols = [col for col in header if cols_rename.get(col, col) in dtypes]
+        dtype = {col: dtypes[cols_rename.get(col, col)] for col in usecols}
+        mapgwb.append( read_cached(pd.read_csv, filename, delimiter=sep, usecols=usecols, dtype=dtype, **cachesettings).rename(columns=cols_rename) )
+
+    # the same PC6 categories in every year, so the concat stays categorical
+    pc6_categories = union_categoricals([mapgwb_year['PC6'] for mapgwb_year in mapgwb]).categories
+    for mapgwb_year in mapgwb:
+        mapgwb_year['PC6'] = mapgwb_year['PC6'].cat.set_categories(pc6_categories)
+    return merge_vintages(mapgwb, ['PC6','Huisnummer'])
+
+pc6index_version = 1 # increase when the layout of the PC6 index changes
+
+def build_pc6_index(mapgwb, mapgem, mapwyk, key=''):
+    # PC6 -> gemeente/wijk lookup as sorted arrays. A PC6 crossing a gemeente and/or wijk border gets the
+    # codes of its first row in mapgwb, i.e. of the year with the highest priority; these PC6's are kept
+    # in 'cross_border'. All wijkcodes in the mapping and the names per code are stored as well.
+    pc6 = mapgwb['PC6'].astype(str).to_numpy()
+    pc6_sorted, first = np.unique(pc6, return_index=True)
+    pc6_combis, ncombis = np.unique(mapgwb.drop_duplicates(subset=['PC6','Gemeentecode','Wijkcode'])['PC6'].astype(str).to_numpy(), return_counts=True)
+    mapgem = mapgem.drop_duplicates(subset='Gemeentecode').sort_values(by='Gemeentecode')
+    mapwyk = mapwyk.drop_duplicates(subset='Wijkcode').sort_values(by='Wijkcode')
+    return {'version': np.array(pc6index_version), 'key': np.array(key),
+            'pc6': pc6_sorted.astype(str),
+            'gemeentecode': mapgwb['Gemeentecode'].to_numpy(dtype='int32')[first],
+            'wijkcode': mapgwb['Wijkcode'].to_numpy(dtype='int32')[first],
+            'cross_border': pc6_combis[ncombis > 1].astype(str),
+            'wijkcodes': np.unique(mapgwb['Wijkcode'].to_numpy(dtype='int32')),
+            'gem_codes': mapgem['Gemeentecode'].to_numpy(dtype='int32'), 'gem_names': mapgem['Gemeentenaam'].astype(str).to_numpy().astype(str),
+            'wyk_codes': mapwyk['Wijkcode'].to_numpy(dtype='int32'), 'wyk_names': mapwyk['Wijknaam'].astype(str).to_numpy().astype(str)}
+
+def save_pc6_index(pc6index, filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    np.savez(filename, **pc6index)
+
+def load_pc6_index(filename, key=''):
+    # the stored PC6 index, or None if there is none or it is from another version or other source files
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as stored:
+        pc6index = dict(stored)
+    if (pc6index['version'] != pc6index_version) or (str(pc6index['key']) != key):
+        return None
+    return pc6index
+
+def geocode(addresses, gdfpc6, mapgwb=None, cache_file=None, remote=None):
+    # coordinates X/Y (RD) and their source ('bron') for addresses (a frame with PC6 and Huisnummer), without a
+    # web service: an address found before by the remote geocoder comes from the cache ('cache'), otherwise a known
+    # PC6 gets the representative point of its PC6 area, 'pc6hnr' if the house number is in the PC6/house number
+    # mapping (mapgwb) and 'pc6' if not. Only the rest goes to 'remote' (if given): a function from the address
+    # rows to a frame with X/Y (NaN if not found), e.g. remote_geocoder('nominatim') or a local stand-in in a test.
+    # Its results are added to cache_file, so a later run needs no remote geocoder for them.
+    pc6 = addresses['PC6'].astype(str).str.replace(' ', '').str.upper()
+    huisnummer = pd.to_numeric(addresses['Huisnummer'], errors='coerce')
+    keys = pc6 + ' ' + huisnummer.astype('Int64').astype(str)
+    output = pd.DataFrame({'X': np.nan, 'Y': np.nan, 'bron': None}, index=addresses.index)
+
+    # found before
+    cache = pd.DataFrame({'X': [], 'Y': []}, index=pd.Index([], name='adres', dtype=str))
+    if cache_file and os.path.exists(cache_file):
+        cache = pd.read_parquet(cache_file)
+    hit = keys.isin(cache.index).to_numpy()
+    output.loc[hit, ['X','Y']] = cache.loc[keys[hit], ['X','Y']].to_numpy()
+    output.loc[hit, 'bron'] = 'cache'
+
+    # PC6 area, with or without the house number in the mapping
+    centers = pd.DataFrame(dict(zip(['X','Y'], representative_xy(gdfpc6.geometry))), index=gdfpc6['PC6'].to_numpy())
+    centers = centers[~centers.index.duplicated(keep='first')]
+    known = (~hit) & pc6.isin(centers.index).to_numpy()
+    output.loc[known, ['X','Y']] = centers.loc[pc6[known]].to_numpy()
+    output.loc[known, 'bron'] = 'pc6'
+    if mapgwb is not None:
+        mapgwb = mapgwb.loc[mapgwb['PC6'].isin(set(pc6[known])), ['PC6','Huisnummer']]
+        in_mapping = pd.MultiIndex.from_arrays([pc6, huisnummer]).isin(pd.MultiIndex.from_frame(mapgwb.astype({'Huisnummer': float})))
+        output.loc[known & in_mapping, 'bron'] = 'pc6hnr'
+
+    # remote, only for the rest
+    todo = output['bron'].isna().to_numpy()
+    if (remote is not None) and todo.any():
+        found = remote(addresses[todo])[['X','Y']].dropna()
+        output.loc[found.index, ['X','Y']] = found.to_numpy()
+        output.loc[found.index, 'bron'] = 'remote'
+        if cache_file and len(found):
+            found.index = pd.Index(keys[found.index], name='adres')
+            cache = pd.concat([cache, found])
+            cache = cache[~cache.index.duplicated(keep='last')]
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            cache.to_parquet(cache_file + '.tmp')
+            os.replace(cache_file + '.tmp', cache_file)
+    return output
+
+def remote_geocoder(name, user_agent='project_voting'):
+    # remote geocoder for geocode by name, only used when configured (needs internet and geopy): 'nominatim'
+    # (OpenStreetMap, at most one request per second)
+    if name != 'nominatim':
+        raise ValueError('Unknown geocoder: %s' % name)
+    from geopy.geocoders import Nominatim # only needed here
+    from geopy.extra.rate_limiter import RateLimiter
+    from pyproj import Transformer
+    geocode_one = RateLimiter(Nominatim(user_agent=user_agent).geocode, min_delay_seconds=1)
+    latlon_to_rd = Transformer.from_crs(4326, 28992, always_xy=True)
+    def remote(addresses):
+        output = pd.DataFrame({'X': np.nan, 'Y': np.nan}, index=addresses.index)
+        for index, address in addresses.iterrows():
+            query = {'postalcode': address['PC6'], 'country': 'Netherlands'}
+            if 'Straatnaam' in address and pd.notna(address['Straatnaam']):
+                query['street'] = '%s %s' % (address['Huisnummer'], address['Straatnaam'])
+            location = geocode_one(query)
+            if location is not None:
+                output.loc[index, ['X','Y']] = latlon_to_rd.transform(location.longitude, location.latitude)
+        return output
+    return remote
+
+def lookup_sorted(keys, values, query):
+    # values for query via binary search in the sorted keys, NaN where the key is not found
+    pos = np.searchsorted(keys, query).clip(max=len(keys)-1)
+    return pd.Series(values[pos]).where(keys[pos] == query).to_numpy()
+
+def lookup_pc6(pc6index, pc6):
+    # gemeente and wijk (codes and names) for a Series of PC6's, aligned to its index
+    pc6 = pd.Series(pc6)
+    output = pd.DataFrame(index=pc6.index)
+    query = pc6.astype(str).to_numpy().astype(str)
+    output['Gemeentecode'] = lookup_sorted(pc6index['pc6'], pc6index['gemeentecode'], query)
+    output['Gemeentenaam'] = lookup_sorted(pc6index['gem_codes'], pc6index['gem_names'], output['Gemeentecode'].to_numpy())
+    output['Wijkcode'] = lookup_sorted(pc6index['pc6'], pc6index['wijkcode'], query)
+    output['Wijknaam'] = lookup_sorted(pc6index['wyk_codes'], pc6index['wyk_names'], output['Wijkcode'].to_numpy())
+    return output
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for the distances of citizens to stemlokalen, used by finding_distances.py. The boxes (grid
+cells) and the stemlokalen are frames with point coordinates X and Y in RD-coordinates (meters); the
+statistics are weighted by the number of inhabitants of the boxes.
+"""
+
+
+#%% # Libraries
+import pandas as pd
+import numpy as np
+# geolocation
+import geopandas as gpd
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+#%% # Functions
+def weighted_average(df, values, weights):
+    d = df[values]
+    w = df[weights]
+    output = (d * w).sum(min_count=1) / w.sum(min_count=1)
+    return output
+
+def weighted_median(df, val, weight):
+    df_sorted = df.sort_values(val)
+    cumsum = df_sorted[weight].cumsum()
+    cutoff = df_sorted[weight].sum(min_count=1) / 2.
+    try:
+        output = df_sorted[cumsum >= cutoff][val].iloc[0]
+    except:
+        output = np.nan
+    return output
+
+def weighted_quantiles(df, by, val, weight, quantiles=[0.5]):
+    # weighted quantiles of val for every group in by, with a single sort on (group, value). Per group
+    # the rule of weighted_median: the first sorted value whose cumulative weight reaches quantile times
+    # the total weight. NaN weights are skipped and groups without any weight give NaN (min_count=1).
+    group, keys = pd.factorize(df[by], sort=True)
+    values = df[val].to_numpy(dtype=float)[group >= 0]
+    weights = df[weight].to_numpy(dtype=float)[group >= 0]
+    group = group[group >= 0]
+    order = np.lexsort((values, group)) # NaN values last within a group, like sort_values
+    group, values, weights = group[order], values[order], weights[order]
+    cumsum = pd.Series(weights).groupby(group).cumsum().to_numpy()
+    total = pd.Series(weights).groupby(group).sum(min_count=1).reindex(range(len(keys))).to_numpy()
+    output = pd.DataFrame(index=keys.rename(by))
+    for quantile in quantiles:
+        reached = np.flatnonzero(cumsum >= total[group]*quantile) # NaN never reaches the cutoff
+        group_reached, first = np.unique(group[reached], return_index=True)
+        output[quantile] = np.nan
+        output.iloc[group_reached, -1] = values[reached[first]]
+    return output
+
+def find_distances(gdf, gdf_sl, col_index='index_right', cols_xy=['X','Y']):
+    # distance from every box to its nearest stemlokaal, all boxes in one array operation
+    index_right = gdf[col_index].to_numpy(dtype=float)
+    valid = index_right > 0 # same rule as the original loop: NaN (and label 0) get no distance
+    iloc_sl = gdf_sl.index.get_indexer(index_right[valid].astype(np.int64))
+    dx = gdf[cols_xy[0]].to_numpy(dtype=float)[valid] - gdf_sl[cols_xy[0]].to_numpy(dtype=float)[iloc_sl]
+    dy = gdf[cols_xy[1]].to_numpy(dtype=float)[valid] - gdf_sl[cols_xy[1]].to_numpy(dtype=float)[iloc_sl]
+    distances = np.full(len(gdf), np.nan)
+    distances[valid] = np.sqrt(dx*dx + dy*dy) # as in GEOS, so identical to GeoSeries.distance
+    return pd.Series(distances, index=gdf.index, name='distance_nearest_SL')
+
+def rank_order(gdf_sl, col_id=None):
+    # position of every stemlokaal in the order of col_id (default: the index), the tie-break of query_ordered
+    keys = gdf_sl.index if col_id is None else gdf_sl[col_id]
+    rank = np.empty(len(gdf_sl), dtype=np.int64)
+    rank[np.argsort(np.asarray(keys), kind='stable')] = np.arange(len(gdf_sl))
+    return rank
+
+def query_ordered(tree, xy, k=1, rank=None, workers=1, **kwargs):
+    # KD-tree query of the k nearest points (arrays of shape (len(xy), k), missing: inf and tree.n), where equal
+    # distances are ordered by 'rank' of the points of the tree instead of by the layout of the tree. One neighbour
+    # more is queried; the rows in which that one still ties with the k-th are queried again with twice as many,
+    # until all points of the tree are queried.
+    distances = np.full((len(xy), k), np.inf)
+    ilocs = np.full((len(xy), k), tree.n)
+    rank = np.append(np.arange(tree.n) if rank is None else rank, np.iinfo(np.int64).max) # missing last
+    rows, extra = np.arange(len(xy)), 1
+    while len(rows):
+        k_query = min(k + extra, tree.n)
+        d, i = tree.query(xy[rows], k=list(range(1, k_query+1)), workers=workers, **kwargs)
+        order = np.lexsort((rank[i], d), axis=-1)
+        d, i = np.take_along_axis(d, order, axis=-1), np.take_along_axis(i, order, axis=-1)
+        distances[rows, :min(k, k_query)], ilocs[rows, :min(k, k_query)] = d[:, :k], i[:, :k]
+        if k_query >= tree.n: # all points queried, nothing more to order
+            break
+        tied = (d[:, -1] == d[:, k-1]) & np.isfinite(d[:, -1])
+        rows, extra = rows[tied], extra*2
+    return distances, ilocs
+
+def find_nearest(gdf, gdf_sl, by=None, cols_sl={'Gemeente':'Gemeente_nearest_SL','Gemeentecode':'Gemeentecode_nearest_SL'},
+                 cols_xy=['X','Y'], col_id=None, workers=1):
+    # nearest stemlokaal and its distance for every box, from one KD-tree query. With 'by' the
+    # tree is keyed by that code (e.g. Gemeentecode): the code is added as a third coordinate so far
+    # apart that a match can only be found within the same code. Boxes without a match in their own
+    # code fall back to the nearest stemlokaal overall. The queries are split over 'workers' threads
+    # (-1: all cores) that share the coordinate arrays; every box is answered on its own, so the
+    # result does not depend on the number of workers. Of stemlokalen at the same distance the first in the order of
+    # col_id (default: the index) is taken, whatever the order of the rows.
+    key_offset = 1e7 # larger than any distance within the Netherlands in RD-coordinates (meters)
+    xy = gdf[cols_xy].to_numpy(dtype=float)
+    xy_sl = gdf_sl[cols_xy].to_numpy(dtype=float)
+    has_xy = np.isfinite(xy_sl).all(axis=1)
+    tree = cKDTree(xy_sl[has_xy])
+    label_sl = gdf_sl.index[has_xy]
+    rank = rank_order(gdf_sl, col_id)[has_xy]
+    if by is None:
+        distances, iloc_sl = (column[:,0] for column in query_ordered(tree, xy, rank=rank, workers=workers))
+    else:
+        codes = gdf[by].to_numpy(dtype=float)
+        codes_sl = gdf_sl[by].to_numpy(dtype=float)[has_xy]
+        has_code = np.isfinite(codes_sl)
+        tree_by = cKDTree(np.column_stack([xy_sl[has_xy][has_code], codes_sl[has_code]*key_offset]))
+        codes = np.where(np.isfinite(codes), codes, -1) # no code -> never matched, so fall back
+        distances, iloc_by = (column[:,0] for column in query_ordered(tree_by, np.column_stack([xy, codes*key_offset]), rank=rank[has_code],
+                                                                       distance_upper_bound=key_offset/2, workers=workers))
+        iloc_sl = np.full(len(gdf), -1)
+        found = np.isfinite(distances)
+        iloc_sl[found] = np.flatnonzero(has_code)[iloc_by[found]]
+        if (~found).any():
+            distances[~found], iloc_sl[~found] = (column[:,0] for column in query_ordered(tree, xy[~found], rank=rank, workers=workers))
+    output = gdf_sl.loc[label_sl[iloc_sl], list(cols_sl)].rename(columns=cols_sl)
+    output.index = gdf.index
+    output['index_right'] = label_sl[iloc_sl]
+    output['distance_nearest_SL'] = distances
+    return output
+
+def find_k_nearest(gdf, gdf_sl, k=2, cols_xy=['X','Y'], col_id=None, workers=1):
+    # the k nearest stemlokalen of every box anywhere (as nearest_method 1) from one KD-tree query: per rank r = 1..k
+    # the index label (index_right_r) and distance (distance_SL_r), stemlokalen at the same distance in the order of
+    # col_id (default: the index). With fewer than k stemlokalen the ranks without one are missing.
+    xy_sl = gdf_sl[cols_xy].to_numpy(dtype=float)
+    has_xy = np.isfinite(xy_sl).all(axis=1)
+    tree = cKDTree(xy_sl[has_xy])
+    distances, iloc_sl = query_ordered(tree, gdf[cols_xy].to_numpy(dtype=float), k=k, rank=rank_order(gdf_sl, col_id)[has_xy], workers=workers)
+    labels = pd.Series(gdf_sl.index[has_xy]).reindex(np.arange(tree.n+1)) # tree.n: no stemlokaal
+    output = pd.DataFrame(index=gdf.index)
+    for r in range(1, k+1):
+        output['index_right_%d' % r] = labels.to_numpy()[iloc_sl[:, r-1]]
+        output['distance_SL_%d' % r] = np.where(np.isfinite(distances[:, r-1]), distances[:, r-1], np.nan)
+    return output
+
+def update_nearest(gdf, gdf_sl, previous, previous_sl, by=None, col_id='_id',
+                   cols_sl={'Gemeente':'Gemeente_nearest_SL','Gemeentecode':'Gemeentecode_nearest_SL'}, cols_xy=['X','Y'], workers=1):
+    # find_nearest after a change of the stemlokalen, from its result before ('previous', for the same boxes) with the
+    # stemlokalen of then ('previous_sl'). The stemlokalen are matched on col_id; a stemlokaal with another place or
+    # gemeente counts as removed and added. Only boxes whose nearest stemlokaal was removed, that are at least as close
+    # to an added one, or (with 'by') that fell back outside their code while an added one has that code, are searched
+    # again. Returns the result of find_nearest and the number of boxes searched again.
+    cols_compare = [col_id] + list(cols_xy) + list(cols_sl) + ([by] if by and by not in cols_sl else [])
+    old, new = previous_sl[cols_compare], gdf_sl[cols_compare]
+    if old[col_id].duplicated().any() or new[col_id].duplicated().any(): # no unique match, so all boxes
+        return find_nearest(gdf, gdf_sl, by=by, cols_sl=cols_sl, cols_xy=cols_xy, col_id=col_id, workers=workers), len(gdf)
+    same = old.merge(new, how='inner', on=cols_compare)[col_id] # NaN matches NaN here
+    removed = set(old[col_id]) - set(same)
+    added = gdf_sl[~new[col_id].isin(set(same))]
+    ids_previous = previous_sl.loc[previous['index_right'], col_id].to_numpy()
+    redo = np.isin(ids_previous, list(removed))
+    if len(added):
+        fallback = (by is not None) and ~(previous[cols_sl[by]].to_numpy(dtype=float) == gdf[by].to_numpy(dtype=float))
+        redo |= closer_to_added(gdf, added, previous['distance_nearest_SL'].to_numpy(), fallback, by=by, cols_xy=cols_xy, workers=workers)
+    output = previous.copy()
+    labels = pd.Series(gdf_sl.index, index=gdf_sl[col_id])
+    output['index_right'] = labels.reindex(ids_previous).to_numpy() # same stemlokalen, new index labels
+    if redo.any():
+        output.loc[redo] = find_nearest(gdf[redo], gdf_sl, by=by, cols_sl=cols_sl, cols_xy=cols_xy, col_id=col_id, workers=workers)
+    output['index_right'] = output['index_right'].astype(gdf_sl.index.dtype)
+    return output, redo.sum()
+
+def closer_to_added(gdf, added, distances, fallback=False, by=None, cols_xy=['X','Y'], workers=1):
+    # boxes whose nearest stemlokaal (at 'distances') may become one of the added stemlokalen: at least as close
+    # to an added one, with 'by' one with their own code. Boxes that fell back outside their own code ('fallback')
+    # also when an added stemlokaal has their code.
+    nearest_all = find_nearest(gdf, added, cols_sl={}, cols_xy=cols_xy, workers=workers)['distance_nearest_SL'].to_numpy()
+    if by is None:
+        return nearest_all <= distances
+    codes = gdf[by].to_numpy(dtype=float)
+    nearest_by = find_nearest(gdf, added, by=by, cols_sl={by: 'code'}, cols_xy=cols_xy, workers=workers)
+    closer_by = (nearest_by['code'].to_numpy(dtype=float) == codes) & (nearest_by['distance_nearest_SL'].to_numpy() <= distances)
+    return np.where(fallback, (nearest_all <= distances) | np.isin(codes, added[by].to_numpy(dtype=float)), closer_by)
+
+def level_distances(gdf, by, val='distance_nearest_SL', weight='aantal_inwoners'):
+    # inhabitants and weighted mean and median distance per code of 'by', as in aggregate_distances
+    output = pd.DataFrame({'inwoners': gdf[weight].groupby(gdf[by]).sum(min_count=1)})
+    output['dist_mean'] = (gdf[val]*gdf[weight]).groupby(gdf[by]).sum(min_count=1) / output['inwoners']
+    output['dist_median'] = weighted_quantiles(gdf, by, val, weight)[0.5]
+    return output
+
+def compare_distances(tables):
+    # tables of level_distances for several elections ({name: table}, same boxes) side by side: the inhabitants, per
+    # election the mean and median distance (dist_mean_<name>, dist_median_<name>) and for the elections after the
+    # first their difference with the first (diff_mean_<name>, diff_median_<name>)
+    names = list(tables)
+    output = pd.DataFrame({'inwoners': tables[names[0]]['inwoners']})
+    for name in names:
+        table = tables[name].reindex(output.index)
+        output['dist_mean_%s' % name] = table['dist_mean']
+        output['dist_median_%s' % name] = table['dist_median']
+    for name in names[1:]:
+        output['diff_mean_%s' % name] = output['dist_mean_%s' % name] - output['dist_mean_%s' % names[0]]
+        output['diff_median_%s' % name] = output['dist_median_%s' % name] - output['dist_median_%s' % names[0]]
+    return output
+
+def scenario_base(gdfboxn, gdf_sl, by=None, levels=['Gemeentecode_nearest_SL','Wijkcode'], col_id='_id',
+                  cols_sl={'Gemeente':'Gemeente_nearest_SL','Gemeentecode':'Gemeentecode_nearest_SL'}, cols_xy=['X','Y']):
+    # baseline for scenario_distances: the boxes with their nearest stemlokaal (gdfboxn, from find_nearest with the
+    # same 'by' on the stemlokalen gdf_sl), a KD-tree of the boxes and the mean and median distances per code of the
+    # levels. Made once, used for any number of scenarios.
+    distances = gdfboxn['distance_nearest_SL'].to_numpy(dtype=float)
+    base = {'boxes': gdfboxn, 'sl': gdf_sl, 'by': by, 'levels': levels, 'col_id': col_id, 'cols_sl': cols_sl, 'cols_xy': cols_xy,
+            'tree': cKDTree(gdfboxn[cols_xy].to_numpy(dtype=float)), 'max_distance': np.nanmax(distances),
+            'ids': gdf_sl.loc[gdfboxn['index_right'], col_id].to_numpy(), 'fallback': False,
+            'tables': {level: level_distances(gdfboxn, level) for level in levels}}
+    if by is not None:
+        base['fallback'] = ~(gdfboxn[cols_sl[by]].to_numpy(dtype=float) == gdfboxn[by].to_numpy(dtype=float))
+    return base
+
+def scenario_distances(base, add=None, remove=[], workers=1):
+    # what if the stemlokalen 'add' (a frame like the stemlokalen: col_id, X/Y and the gemeente columns) open and
+    # the stemlokalen with col_id in 'remove' close, from the baseline of scenario_base. Only the boxes whose nearest
+    # stemlokaal closes, or that are at least as close to an added one (candidates from the KD-tree of the boxes),
+    # are searched again, and only the codes with such boxes are recomputed. Returns per level and changed code
+    # the inhabitants, mean and median distance after the scenario and before ('_base'); a code without boxes after
+    # the scenario has 0 inhabitants and no distances.
+    boxes, sl, by, cols_xy = base['boxes'], base['sl'], base['by'], base['cols_xy']
+    sl_scenario = sl[~sl[base['col_id']].isin(set(remove))]
+    redo = np.isin(base['ids'], list(remove))
+    if (add is not None) and len(add):
+        add = add.set_axis(np.arange(len(add)) + sl.index.max() + 1) # new index labels
+        sl_scenario = pd.concat([sl_scenario, add])
+        near = base['tree'].query_ball_point(add[cols_xy].to_numpy(dtype=float), r=base['max_distance'])
+        candidates = [np.asarray(positions, dtype=np.int64) for positions in near]
+        if by is not None:
+            candidates.append(np.flatnonzero(base['fallback'] & np.isin(boxes[by].to_numpy(dtype=float), add[by].to_numpy(dtype=float))))
+        candidates = np.unique(np.concatenate(candidates))
+        fallback = base['fallback'][candidates] if by is not None else False
+        closer = closer_to_added(boxes.iloc[candidates], add, boxes['distance_nearest_SL'].to_numpy()[candidates], fallback,
+                                 by=by, cols_xy=cols_xy, workers=workers)
+        redo[candidates[closer]] = True
+    positions = np.flatnonzero(redo)
+    nearest = find_nearest(boxes.iloc[positions], sl_scenario, by=by, cols_sl=base['cols_sl'], cols_xy=cols_xy, col_id=base['col_id'], workers=workers)
+    output = []
+    for level in base['levels']:
+        cols_new = [col for col in [level,'distance_nearest_SL'] if col in nearest.columns]
+        changed = np.unique(np.concatenate([boxes[level].to_numpy()[positions], nearest[level].to_numpy() if level in nearest else []]))
+        gdf = boxes.loc[boxes[level].isin(changed), [level,'distance_nearest_SL','aantal_inwoners']].copy() # includes all boxes searched again
+        gdf.loc[nearest.index, cols_new] = nearest[cols_new].to_numpy()
+        table = level_distances(gdf, level).reindex(changed) # also the codes that lose all their boxes
+        table['inwoners'] = table['inwoners'].fillna(0)
+        table = table.join(base['tables'][level].reindex(table.index), rsuffix='_base')
+        output.append(table.rename_axis('code').reset_index().assign(level=level))
+    output = pd.concat(output, ignore_index=True)
+    return output[['level','code'] + [col for col in output.columns if col not in ['level','code']]]
+
+def scenario_batch(base, scenarios, workers=1):
+    # scenario_distances for many scenarios on one baseline, e.g. every candidate location of a new stemlokaal:
+    # scenarios is a dict of name: {'add': ..., 'remove': ...}. Returns one table with a column scenario.
+    output = [scenario_distances(base, workers=workers, **scenario).assign(scenario=name) for name, scenario in scenarios.items()]
+    output = pd.concat(output, ignore_index=True)
+    return output[['scenario'] + [col for col in output.columns if col != 'scenario']]
+
+def network_graph(gdf_lines, precision=0.01):
+    # graph of a road network from its lines (RD-coordinates, e.g. an OSM extract converted offline): every vertex of
+    # the lines is a node (vertices within 'precision' meters are the same node), so roads crossing at a shared vertex
+    # are connected, and every segment between two vertices is an edge weighted by its length. Lines crossing without
+    # a shared vertex (bridges, tunnels) stay apart. Of parallel segments between two nodes only the shortest is kept.
+    lines = gdf_lines.geometry.explode(index_parts=False)
+    lines = lines[lines.notna() & ~lines.is_empty].reset_index(drop=True)
+    coords = [np.asarray(line.coords)[:, :2] for line in lines] # shapely 1.8: no GeoSeries.get_coordinates yet
+    xy = np.concatenate(coords) if coords else np.empty((0, 2))
+    part = np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    keys, node = np.unique(np.round(xy / precision).astype(np.int64), axis=0, return_inverse=True)
+    node = node.ravel()
+    segment = part[1:] == part[:-1] # consecutive vertices of the same line
+    a, b = node[:-1][segment], node[1:][segment]
+    length = np.hypot(*(xy[1:][segment] - xy[:-1][segment]).T)
+    edges = pd.DataFrame({'a': np.minimum(a, b), 'b': np.maximum(a, b), 'length': length})
+    edges = edges[edges['a'] != edges['b']].groupby(['a','b'], sort=False)['length'].min().reset_index()
+    graph = coo_matrix((edges['length'].to_numpy(), (edges['a'].to_numpy(), edges['b'].to_numpy())), shape=(len(keys), len(keys))).tocsr()
+    return {'xy': keys * precision, 'graph': graph}
+
+def network_distances(network, gdf_sl, cols_xy=['X','Y'], workers=1):
+    # for every node of the road network of network_graph its distance to, and the index label of, its nearest
+    # stemlokaal. Every stemlokaal is an extra node linked to its nearest network node, so this is one
+    # multi-source Dijkstra from all stemlokalen at once. Nodes that no stemlokaal reaches are left out.
+    xy_sl = gdf_sl[cols_xy].to_numpy(dtype=float)
+    has_xy = np.isfinite(xy_sl).all(axis=1)
+    nnodes, nsl = len(network['xy']), has_xy.sum()
+    link_sl, node_sl = cKDTree(network['xy']).query(xy_sl[has_xy], workers=workers)
+    graph = network['graph'].tocoo()
+    graph = coo_matrix((np.concatenate([graph.data, link_sl]),
+                        (np.concatenate([graph.row, node_sl]), np.concatenate([graph.col, nnodes + np.arange(nsl)]))),
+                       shape=(nnodes + nsl, nnodes + nsl)).tocsr()
+    distances, predecessors, sources = dijkstra(graph, directed=False, indices=nnodes + np.arange(nsl), min_only=True,
+                                                return_predecessors=True)
+    reached = np.isfinite(distances[:nnodes])
+    return {'xy': network['xy'][reached], 'distance': distances[:nnodes][reached],
+            'index_right': gdf_sl.index[has_xy][sources[:nnodes][reached] - nnodes]}
+
+def find_nearest_network(gdf, gdf_sl, network_sl, cols_sl={'Gemeente':'Gemeente_nearest_SL','Gemeentecode':'Gemeentecode_nearest_SL'},
+                         cols_xy=['X','Y'], workers=1):
+    # nearest stemlokaal over the road network, in the output format of find_nearest, from the node distances of
+    # network_distances. A box is linked to its nearest node: its distance is the straight line to that node plus
+    # the network distance from there (including the link of the stemlokaal).
+    link, node = cKDTree(network_sl['xy']).query(gdf[cols_xy].to_numpy(dtype=float), workers=workers)
+    label_sl = network_sl['index_right'][node]
+    output = gdf_sl.loc[label_sl, list(cols_sl)].rename(columns=cols_sl)
+    output.index = gdf.index
+    output['index_right'] = label_sl
+    output['distance_nearest_SL'] = link + network_sl['distance'][node]
+    return output
+
+def aggregate_distances(gdf, by, codes, cols_first={}, val='distance_nearest_SL', weight='aantal_inwoners', quantiles=[], means={}):
+    # all afstanden of one level (gemeente, wijk) in one grouped pass over the boxes, optionally with extra
+    # weighted quantiles (dist_p25, ...) and weighted means of other columns ({column: name}). Returns the table
+    # for the codes that have boxes (sorted by code) and the list of codes without any box.
+    codes = sorted(set(codes))
+    gdf_sub = gdf[gdf[by].isin(codes)]
+    grouped = gdf_sub.groupby(by, sort=True)
+    output = gdf_sub.drop_duplicates(subset=by).set_index(by)[list(cols_first)].rename(columns=cols_first) # first row per group
+    output['inwoners'] = grouped['aantal_inwoners'].sum(min_count=1)
+    output['woningwaarde'] = grouped['gemiddelde_woz_waarde_woning'].mean()
+    output['uitkering'] = grouped['aantal_personen_met_uitkering_onder_aowlft'].sum(min_count=1)
+    output['dist_mean'] = (gdf_sub[val]*gdf_sub[weight]).groupby(gdf_sub[by]).sum(min_count=1) / grouped[weight].sum(min_count=1)
+    distances = weighted_quantiles(gdf_sub, by, val, weight, quantiles=[0.5]+list(quantiles))
+    output['dist_median'] = distances[0.5]
+    for quantile in quantiles:
+        output['dist_p%d' % round(quantile*100)] = distances[quantile]
+    for col, name in means.items():
+        output[name] = (gdf_sub[col]*gdf_sub[weight]).groupby(gdf_sub[by]).sum(min_count=1) / grouped[weight].sum(min_count=1)
+    output = output.sort_index()
+    missing = [code for code in codes if code not in output.index]
+    return output, missing
+
+def distance_sums(gdf, by, cols_first={}, val='distance_nearest_SL', weight='aantal_inwoners', sums=None):
+    # running aggregator for aggregate_distances: the sums and counts (of non-missing values) per code of 'by' for
+    # one chunk of boxes, added to the sums of the chunks before. See distance_table for the afstanden table.
+    gdf = gdf[gdf[by].notna()]
+    grouped = gdf.groupby(by, sort=True)
+    part = gdf.drop_duplicates(subset=by).set_index(by)[list(cols_first)] # first row per group
+    for col in ['aantal_inwoners','gemiddelde_woz_waarde_woning','aantal_personen_met_uitkering_onder_aowlft']:
+        part[col] = grouped[col].sum()
+        part[col + '_n'] = grouped[col].count()
+    weighted = gdf[val]*gdf[weight]
+    part['afstand'] = weighted.groupby(gdf[by]).sum()
+    part['afstand_n'] = weighted.groupby(gdf[by]).count()
+    part['gewicht'] = grouped[weight].sum()
+    part['gewicht_n'] = grouped[weight].count()
+    if sums is None:
+        return part
+    sums = pd.concat([sums, part])
+    return sums.groupby(level=0, sort=True).agg({col: 'first' if col in cols_first else 'sum' for col in sums.columns})
+
+def distance_table(sums, codes, cube, cols_first={}, quantiles=[]):
+    # the table of aggregate_distances from the running sums of distance_sums. The weighted median and quantiles
+    # come from the distance cube, interpolated within its bins (so up to one bin width from the exact value).
+    codes = sorted(set(codes))
+    sums = sums[sums.index.isin(codes)].sort_index()
+    output = sums[list(cols_first)].rename(columns=cols_first)
+    output['inwoners'] = sums['aantal_inwoners'].where(sums['aantal_inwoners_n'] > 0) # as sum(min_count=1)
+    output['woningwaarde'] = sums['gemiddelde_woz_waarde_woning'] / sums['gemiddelde_woz_waarde_woning_n'].where(sums['gemiddelde_woz_waarde_woning_n'] > 0)
+    output['uitkering'] = sums['aantal_personen_met_uitkering_onder_aowlft'].where(sums['aantal_personen_met_uitkering_onder_aowlft_n'] > 0)
+    output['dist_mean'] = sums['afstand'].where(sums['afstand_n'] > 0) / sums['gewicht'].where(sums['gewicht_n'] > 0)
+    distances = cube_table(cube, sums.index.name, quantiles=[0.5]+list(quantiles)).reindex(output.index)
+    output['dist_median'] = distances['dist_p50']
+    for quantile in quantiles:
+        output['dist_p%d' % round(quantile*100)] = distances['dist_p%d' % round(quantile*100)]
+    missing = [code for code in codes if code not in output.index]
+    return output, missing
+
+def distance_cube(gdf, by, val='distance_nearest_SL', weight='aantal_inwoners', bin_width=10, max_distance=10000, min_weight=5):
+    # distribution of the distances as a cube of arrays: for every combination of the codes in 'by' (e.g. gemeente
+    # and wijk) and every distance bin the number of inhabitants ('inwoners'), the sum of their distances ('afstand')
+    # and the number of boxes with more than min_weight inhabitants ('gebieden'). Distances from max_distance on
+    # are in the last bin. Every coarser level follows by summing the combinations, see cube_table.
+    distances = gdf[val].to_numpy(dtype=float)
+    weights = np.nan_to_num(gdf[weight].to_numpy(dtype=float))
+    valid = np.isfinite(distances) & gdf[by].notna().all(axis=1).to_numpy()
+    keys = gdf.loc[valid, by]
+    group = keys.groupby(by, sort=True).ngroup().to_numpy()
+    codes = keys.drop_duplicates().sort_values(by=by)
+    edges = np.append(np.arange(0, max_distance + bin_width, bin_width, dtype=float), np.inf)
+    nbins = len(edges) - 1
+    flat = group*nbins + np.minimum(distances[valid] // bin_width, nbins - 1).astype(np.int64)
+    layers = {'inwoners': weights[valid], 'afstand': weights[valid]*distances[valid], 'gebieden': (weights[valid] > min_weight)*1.}
+    cube = {'by': np.array(by), 'codes': codes.to_numpy(dtype=np.int64), 'edges': edges}
+    for layer, values in layers.items():
+        cube[layer] = np.bincount(flat, weights=values, minlength=len(codes)*nbins).reshape(len(codes), nbins)
+    return cube
+
+def add_cubes(cube, part):
+    # running distance cube: the cube of the chunks before plus the cube of one more chunk (same bins)
+    if cube is None:
+        return part
+    codes, group = np.unique(np.concatenate([cube['codes'], part['codes']]), axis=0, return_inverse=True)
+    output = {'by': cube['by'], 'codes': codes, 'edges': cube['edges']}
+    for layer in ['inwoners','afstand','gebieden']:
+        output[layer] = np.zeros((len(codes), len(cube['edges']) - 1))
+        np.add.at(output[layer], group.ravel(), np.concatenate([cube[layer], part[layer]]))
+    return output
+
+def cube_table(cube, by=None, quantiles=[0.5]):
+    # inhabitants, mean distance and weighted quantiles (dist_p50, ...) per code of one level of the cube (by=None:
+    # national), only from the summed bins. The means are exact, the quantiles are interpolated within their bin.
+    codes = pd.DataFrame(cube['codes'], columns=list(cube['by']))
+    group = codes[by].to_numpy() if by else np.zeros(len(codes), dtype=int)
+    inwoners = pd.DataFrame(cube['inwoners']).groupby(group).sum()
+    output = pd.DataFrame(index=inwoners.index.rename(by))
+    output['inwoners'] = inwoners.sum(axis=1)
+    output['dist_mean'] = pd.DataFrame(cube['afstand']).groupby(group).sum().sum(axis=1) / output['inwoners'].where(output['inwoners'] > 0)
+    cumsum = inwoners.cumsum(axis=1).to_numpy()
+    edges = cube['edges']
+    for quantile in quantiles:
+        target = cumsum[:, -1]*quantile
+        reached = np.minimum((cumsum < target[:, None]).sum(axis=1), len(edges) - 2) # first bin reaching the target
+        before = np.where(reached > 0, cumsum[np.arange(len(cumsum)), reached - 1], 0)
+        inbin = cumsum[np.arange(len(cumsum)), reached] - before
+        width = edges[reached + 1] - edges[reached]
+        fraction = np.divide(target - before, inbin, out=np.zeros(len(target)), where=inbin > 0)
+        value = edges[reached] + np.where(np.isfinite(width), fraction*width, 0) # last bin: its lower edge
+        output['dist_p%d' % round(quantile*100)] = np.where(cumsum[:, -1] > 0, value, np.nan)
+    return output
+
+def find_distances_loop(gdf, gdf_sl, col_index='index_right', cols_xy=['X','Y']):
+    # original per-box loop on Shapely points, only kept as reference for the benchmark
+    gdf = gpd.GeoDataFrame(gdf[[col_index]], geometry=gpd.points_from_xy(gdf[cols_xy[0]], gdf[cols_xy[1]]))
+    gdf_sl = gpd.GeoSeries(gpd.points_from_xy(gdf_sl[cols_xy[0]], gdf_sl[cols_xy[1]]), index=gdf_sl.index)
+    distances = pd.Series(np.nan, index=gdf.index, name='distance_nearest_SL')
+    for index in gdf.index:
+        gdfi = gdf.loc[index:index]
+        if gdfi[col_index].values[0] > 0:
+            wimsi = gdf_sl.loc[gdfi[col_index]]
+            calculateddistance = gdfi.distance( wimsi, align=False )
+            distances.loc[index] = calculateddistance.values[0]
+    return distances
@@ -12,6 +12,17 @@ considering all files, which means that the dataset with the oldest date limits
 some of the data. There is also a section that is designed for checking once more the deduplication
 from stembureaus to stemlokalen. At the end, some plots are made that can be used in the final
 report.
+
+The work is split in stages (read, clean, nearest, distances, aggregate, save, plot) that pass their results
+on in a state dictionary. With do_stream the stream stage takes the place of nearest, distances and aggregate:
+it goes through the grid in parts and only keeps running sums, so the boxes are never all in memory. Paths, file names and settings come from config.ini (next to this file) and
+optionally other ini files on top of it. The outputs of the stages are kept as checkpoints, so a rerun only
+recomputes a stage when its code, settings or inputs have changed. From the command line, e.g.:
+
+    python finding_distances.py --config server.ini --skip plot
+    python finding_distances.py --stages read clean nearest distances --set nearest_method=1
+
+Interactively: state = run_pipeline(load_config(), stages=['read','clean']).
 """
 
 
@@ -20,20 +31,32 @@ import pandas as pd
 import numpy as np
 # system
 import os
+import sys
+import ast
+import hashlib
+import inspect
+import argparse
+import configparser
 # geolocation
 import geopandas as gpd # gpd.show_versions()
 from geopandas.tools import sjoin_nearest
-from geopy.geocoders import Nominatim
+from pyproj import Transformer
 # others
 import gc
+import time
 from collections import Counter
-# plot
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+# own functions
+from data_functions import read_cached, read_grid, iter_grid, merge_vintages, geocode, remote_geocoder, files_key, save_checkpoint, load_checkpoint, check_duplicates, find_near_duplicates, read_mapping_gwb, build_pc6_index, save_pc6_index, load_pc6_index, lookup_pc6
+from distance_functions import weighted_average, weighted_median, find_distances, find_distances_loop, find_nearest, find_k_nearest, aggregate_distances, distance_cube
+from distance_functions import distance_sums, distance_table, add_cubes, cube_table, network_graph, network_distances, find_nearest_network, update_nearest, scenario_base
+from distance_functions import level_distances, compare_distances
+from data_functions import representative_xy, csv_delimiter, lookup_sorted # only for the stage keys, see stage_helpers
+from distance_functions import rank_order, query_ordered, closer_to_added, weighted_quantiles # idem
+from plot_functions import plot_figure
 
 
 #%% # Environment
-from IPython.core.interactiveshell import InteractiveShell
-InteractiveShell.ast_node_interactivity = "all"
 pd.set_option("display.max_rows",100)
 pd.set_option("display.max_columns",8)
 pd.set_option("min_rows",20)
@@ -41,732 +64,835 @@ pd.set_option('display.width', 150)
 pd.set_option('display.max_colwidth', 25)
 
 
-#%% # Functions
-def find_all_filenames(path_to_dir, suffix=".xlsx", prefix=''):
-    filenames = os.listdir(path_to_dir)
-    return [ filename for filename in filenames if (filename.endswith(suffix)) & (filename.startswith(prefix)) ]
-
-def weighted_average(df, values, weights):
-    d = df[values]
-    w = df[weights]
-    output = (d * w).sum(min_count=1) / w.sum(min_count=1)
-    return output
-
-def weighted_median(df, val, weight):
-    df_sorted = df.sort_values(val)
-    cumsum = df_sorted[weight].cumsum()
-    cutoff = df_sorted[weight].sum(min_count=1) / 2.
-    try:
-        output = df_sorted[cumsum >= cutoff][val].iloc[0]
-    except:
-        output = np.nan
-    return output
-
-
-#%% # Paths
-mypath = "G:\\Projecten\\Data Science\\8577_Meting Stemlokalen Tweede Kamer 2023\\Data\\"
-subwms = "WIMS\\"
-subksr = "Kiesraad\\"
-subcbs = "CBS\\"
-subgeo = "Geolocation\\"
-submap = "Mapping\\"
-
-anpath = "G:\\Projecten\\Data Science\\8577_Meting Stemlokalen Tweede Kamer 2023\\Analyses\\"
-subglv = 'gemeente_level\\'
-subwlv = 'wijk_level\\'
-
-fileWOR = "TweedeKamer-verkiezingen_20231124_DataV1.5.csv"
-# fileWMS = "TweedeKamer-verkiezingen_20231124_DataV1.5_apiupdated_checked_deduplicated_checked_kiesraadappended.xlsx"
-fileWMS = "TweedeKamer-verkiezingen_20231124_DataV1.5_apiupdated_checked_deduplicated_checked_kiesraadappended_checked.xlsx"
-file500 = "cbs_vk500_2021_v2.gpkg"
-filePc6 = "2023-cbs_pc6_2021_v2\\cbs_pc6_2021_v2.gpkg" # 2021
-# filePc6 = "2023-cbs_pc6_2022_v1\\cbs_pc6_2022_v1.gpkg" # 2022
-# filePc6 = "CBS-PC6-2020-v1\\CBS_pc6_2020_v1.shp" # old way
-fileKWB23 = "kwb-2023.xls" # is niet up to date
-fileKWB22 = "kwb-2022.xls"
-fileKWB21 = "kwb-2021.xls"
-fileKWB20 = "kwb-2020.xls"
-fileKWB19 = "kwb-2019.xls"
-
-filemapGWB23 = "pc6hnr20230801_gwb.csv"
-filemapGWB22 = "pc6hnr20220801_gwb.csv"
-filemapGWB21 = "pc6hnr20210801_gwb.csv"
-filemapGWB20 = "pc6hnr20200801_gwb.csv"
-filemapGWB19 = "pc6hnr20190801_gwb.csv"
-filemapGEM23 = "gemeenten_2023.csv"
-filemapGEM22 = "gem2022.csv"
-filemapGEM21 = "gem2021.csv"
-filemapGEM20 = "gem2020.csv"
-filemapGEM19 = "gem2019.csv"
-filemapWYK23 = "wijk_2023.csv"
-filemapWYK22 = "Wijken2022.csv"
-filemapWYK21 = "wijk2021.csv"
-filemapWYK20 = "wijk2020.csv"
-filemapWYK19 = "wijk2019.csv"
-
-
-#%% # Initialize
-geolocator = Nominatim(user_agent="project_voting") # also Google or Bing possible
-
-myrng = 2               # chosen random number seed
-mydpi = 500             # chosen dots-per-inch (dpi) level
-do_save_distances = 1   # save distances to a file?
-verbose = 1             # how much prints should be made
+#%% # Configuration
+configfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+
+def load_config(filenames=[], overrides={}):
+    # settings from config.ini, then from the given ini files and overrides (key: value) on top of it
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str # keep the case of the keys
+    for filename in [configfile] + list(filenames):
+        if not parser.read(filename):
+            raise FileNotFoundError('Config file not found: %s' % filename)
+    cfg = {}
+    for section in parser.sections():
+        for key, value in parser.items(section):
+            cfg[key] = ast.literal_eval(value) if section == 'settings' else value
+    for key, value in overrides.items():
+        cfg[key] = ast.literal_eval(value) if isinstance(value, str) and parser.has_option('settings', key) else value
+    if not cfg['cachepath']:
+        cfg['cachepath'] = os.path.join(cfg['mypath'], 'Cache')
+    if cfg['do_stream'] and cfg['elections']:
+        raise ValueError('Comparing elections needs all boxes at once, not with do_stream')
+    return cfg
+
+def datafile(cfg, sub, file):
+    # full path of an input file, e.g. datafile(cfg, 'subcbs', 'file500')
+    return os.path.join(cfg['mypath'], cfg[sub], cfg[file])
+
+def grid_file(cfg):
+    # the CBS grid of the boxes (500 m or 100 m)
+    return datafile(cfg, 'subcbs', 'file%d' % cfg['grid'])
+
+def network_files(cfg):
+    # the road network, only read for nearest_method 3
+    return [datafile(cfg, 'subgeo', 'fileNetwork')] if cfg['nearest_method'] == 3 else []
+
+def cache_settings(cfg):
+    # arguments of read_cached
+    return {'cache_dir': cfg['cachepath'] if cfg['do_use_cache'] else None, 'refresh': cfg['do_refresh_cache']}
+
+def read_network(cfg):
+    # road network for nearest_method 3 as a graph, see network_graph
+    return network_graph(read_cached(gpd.read_file, network_files(cfg)[0], **cache_settings(cfg)))
+
+def load_network(cfg, dfwimsf, network=None):
+    # road network for nearest_method 3 with the distance to the nearest stemlokaal of every node, see network_distances
+    network = read_network(cfg) if network is None else network
+    return network_distances(network, dfwimsf, workers=cfg['n_workers'])
+
+def nearest_stemlokalen(cfg, gdfbox, dfwimsf, network_sl=None):
+    # nearest stemlokaal and its distance for every box, by the chosen nearest_method
+    if cfg['nearest_method'] == 3:
+        return find_nearest_network(gdfbox, dfwimsf, network_sl, workers=cfg['n_workers'])
+    return find_nearest(gdfbox, dfwimsf, by='Gemeentecode' if cfg['nearest_method'] == 2 else None, col_id='_id', workers=cfg['n_workers'])
+
+def input_files(cfg):
+    # all files read in stage_read
+    filenames = [datafile(cfg, 'subwms', 'fileWOR'), datafile(cfg, 'subwms', 'fileWMS'), grid_file(cfg),
+                 datafile(cfg, 'subcbs', 'filePc6'), datafile(cfg, 'submap', 'filemapGEM23')]
+    filenames += [datafile(cfg, 'subcbs', 'fileKWB%02d' % (year % 100)) for year in cfg['kwb_years']]
+    filenames += [datafile(cfg, 'submap', 'file%s%02d' % (kind, year % 100)) for kind in ['mapGWB','mapGEM','mapWYK'] for year in cfg['map_years']]
+    return filenames
+
+def election_files(cfg):
+    # the WIMS files (in subwms) of the elections to compare, see stage_compare
+    return [datafile(cfg, 'subwms', source) for source in cfg['elections'].values() if source not in ['dfwimso','dfwimsf']]
+
+def select_wims(dfwims):
+    # the columns of a WIMS file used here, renamed, with the gemeentecode as a number
+    cols_wims = ['_id','Gemeente','CBS gemeentecode','Naam stembureau','Type stembureau','Gebruiksdoel van het gebouw',
+                 'Straatnaam','Huisnummer','Huisletter','Postcode','X','Y','Latitude','Longitude',
+                 'Openingstijd','Sluitingstijd','Toegankelijk voor mensen met een lichamelijke beperking']
+    cols_rename = {'Toegankelijk voor mensen met een lichamelijke beperking':'Toegankelijkheid',
+                   'CBS gemeentecode':'Gemeentecode'}
+    dfwims = dfwims[cols_wims].rename(columns=cols_rename)
+
+    # replace GM from gemeentecode and leading 0
+    dfwims['Gemeentecode'] = dfwims['Gemeentecode'].str.replace('GM','').astype(int)
+    return dfwims
+
+def print_sanity(gdf, col_gemeente):
+    # inhabitants of some gemeenten, to compare with the known numbers
+    for gemeente in ['Amsterdam','Tilburg','Eemsdelta','Appingedam','Loppersum','Simpelveld']:
+        print('...', gemeente, gdf.loc[gdf[col_gemeente]==gemeente, 'aantal_inwoners'].sum())
+
+# columns of the mapping files (per year) renamed to one name
+cols_rename_mapping = {'Gemcode2022':'Gemeentecode','Gemcode2021':'Gemeentecode','Gemcode2020':'Gemeentecode','Gemcode2019':'Gemeentecode',
+                       'Gemeente2022':'Gemeentecode','Gemeente2021':'Gemeentecode','Gemeente2020':'Gemeentecode','Gemeente2019':'Gemeentecode',
+                       'Gemeentenaam2022':'Gemeentenaam','Gemeentenaam2021':'Gemeentenaam','Gemeentenaam2020':'Gemeentenaam','Gemeentenaam2019':'Gemeentenaam',
+                       'Buurt2020':'Buurt','Buurt2021':'Buurt','Buurt2022':'Buurt','Buurt2019':'Buurt',
+                       'Wijk2020':'Wijkcode','Wijk2021':'Wijkcode','Wijk2022':'Wijkcode','Wijk2019':'Wijkcode',
+                       'wijkcode2022':'Wijkcode','wijkcode2021':'Wijkcode','wijkcode2020':'Wijkcode','Wijkcode2019':'Wijkcode',
+                       'wijknaam2022':'Wijknaam','wijknaam2021':'Wijknaam','wijknaam2020':'Wijknaam','Wijknaam_2019K_NAAM':'Wijknaam'}
+
+# how to read the gemeente/wijk mapping files per year (map_years can only take these years)
+readsettings_mapping = {2022: {'delimiter': ';'}, 2021: {'delimiter': ';'}, 2019: {'delimiter': ';'},
+                        2020: {'delimiter': ';', 'encoding': 'unicode_escape'}}
+
+# columns of the boxes used later (besides the box id and X/Y)
+cols_box = ['aantal_inwoners','gemiddelde_woz_waarde_woning','aantal_personen_met_uitkering_onder_aowlft']
 
 
 #%% # Read
-# stembureaus en verkiezingen
-dfwimso = pd.read_csv(mypath + subwms + fileWOR) # 2023, original downloaded version
-dfwimsf = pd.read_excel(mypath + subwms + fileWMS) # 2023, deduplicated checked final version WIMS
-
-# CBS gegevens
-gdfbox = gpd.read_file(mypath + subcbs + file500) # 2021
-gdfpc6 = gpd.read_file(mypath + subcbs + filePc6) # 2021
-dfkwb23 = pd.read_excel(mypath + subcbs + fileKWB23, decimal=',') # we take 2021, because 2022/2023 is not up to date
-dfkwb22 = pd.read_excel(mypath + subcbs + fileKWB22, decimal=',') # we take 2021, because 2022/2023 is not up to date
-dfkwb21 = pd.read_excel(mypath + subcbs + fileKWB21, decimal=',') # we take 2021, because 2022/2023 is not up to date
-dfkwb20 = pd.read_excel(mypath + subcbs + fileKWB20, decimal=',') # we take 2021, because 2022/2023 is not up to date
-dfkwb19 = pd.read_excel(mypath + subcbs + fileKWB19, decimal=',') # we take 2021, because 2022/2023 is not up to date
-
-# mapping
-mapgwb23 = pd.read_csv(mypath + submap + filemapGWB23, delimiter=',', low_memory=False)
-mapgem23 = pd.read_csv(mypath + submap + filemapGEM23, delimiter='\t', encoding= 'unicode_escape')
-mapwyk23 = pd.read_csv(mypath + submap + filemapWYK23, delimiter='\t', encoding= 'unicode_escape')
-mapgwb22 = pd.read_csv(mypath + submap + filemapGWB22, delimiter=';')
-mapgem22 = pd.read_csv(mypath + submap + filemapGEM22, delimiter=';')
-mapwyk22 = pd.read_csv(mypath + submap + filemapWYK22, delimiter=';')
-mapgwb21 = pd.read_csv(mypath + submap + filemapGWB21, delimiter=';')
-mapgem21 = pd.read_csv(mypath + submap + filemapGEM21, delimiter=';')
-mapwyk21 = pd.read_csv(mypath + submap + filemapWYK21, delimiter=';')
-mapgwb20 = pd.read_csv(mypath + submap + filemapGWB20, delimiter=';')
-mapgem20 = pd.read_csv(mypath + submap + filemapGEM20, delimiter=';', encoding= 'unicode_escape')
-mapwyk20 = pd.read_csv(mypath + submap + filemapWYK20, delimiter=';', encoding= 'unicode_escape')
-mapgwb19 = pd.read_csv(mypath + submap + filemapGWB19, delimiter=';')
-mapgem19 = pd.read_csv(mypath + submap + filemapGEM19, delimiter=';')
-mapwyk19 = pd.read_csv(mypath + submap + filemapWYK19, delimiter=';')
-
-# keep originals
-do_keep_orig = 0
-if do_keep_orig == 1:
-    dfwims0 = dfwimsf.copy()
-    gdfbox0 = gdfbox.copy()
-    gdfpc60 = gdfpc6.copy()
-    dfkwb0  = dfkwb22.copy()
-
-# clear memory
-gc.collect()
-
-
-#%% # Explore
-do_explore = 0
-if do_explore:
-    print(dfwimsf.isna().sum())
-
-
-#%% # Check duplicates
-do_check_again = 1
-if do_check_again:
-
-    # find cases with same coordinate (lat,lon) but different address (gem,pc6,str), and vice versa
-    dfwimsf_ = dfwimsf.copy()
-    dfwimsf_ = dfwimsf_.dropna(subset='Postcode')
-    dfwimsf_ = dfwimsf_.apply(lambda x: x.astype(str).str.lower())
-    tokeep = False
-
-    # same address & same coordinate
-    todrop_a1 = ['Gemeente','Straatnaam','Postcode','Latitude','Longitude']
-    dfwimsf_z2 = dfwimsf_.drop_duplicates( subset=todrop_a1, keep=tokeep ); print(dfwimsf_z2.shape)
-
-    # different address & different coordinate
-    todrop_a2 = ['Latitude','Longitude']
-    dfwimsf_x = dfwimsf_.drop_duplicates( subset=todrop_a2, keep=tokeep )
-    dfwimsf_x_ix = dfwimsf_x.index
-    todrop_a3 = ['Gemeente','Straatnaam','Postcode']
-    dfwimsf_y = dfwimsf_.drop_duplicates( subset=todrop_a3, keep=tokeep )
-    dfwimsf_y_ix = dfwimsf_y.index
-    alldiff_ix = list( set(dfwimsf_x_ix).intersection( set(dfwimsf_y_ix) ) )
-    dfwimsf_z1 = dfwimsf_.loc[alldiff_ix]; print(dfwimsf_z1.shape)
-
-    # to check amount
-    check_indx = list( (set(dfwimsf_z1.index)^set(dfwimsf_z2.index)) )
-    check_indx = list( (set(dfwimsf_z1.index).symmetric_difference( set(dfwimsf_z2.index)) ) )
-
-    check_also = list(set(check_indx) - set(list(dfwimsf[dfwimsf['check_deduplication']==1].index)))
-    dfwimsf.loc[check_also, 'check_deduplication'] = 11
-
-
-#%% # Select
-cols_wims = ['_id','Gemeente','CBS gemeentecode','Naam stembureau','Type stembureau','Gebruiksdoel van het gebouw',
-             'Straatnaam','Huisnummer','Huisletter','Postcode','X','Y','Latitude','Longitude',
-             'Openingstijd','Sluitingstijd','Toegankelijk voor mensen met een lichamelijke beperking']
-dfwimsf = dfwimsf[cols_wims].copy()
-dfwimso = dfwimso[cols_wims].copy()
-
-# merge multiple years of KWB data
-'''
-This is a clever piece
-'''
-# dfkwbw = dfkwb22.copy() # we take 2021, because 2022/2023 is not up to date
-dfkwbw = dfkwb21.copy()   # we take 2021, because 2022/2023 is not up to date
-# dfkwbw = pd.concat([dfkwbw, dfkwb21.loc[dfkwb21['gwb_code_10'].isin(set(dfkwb21['gwb_code_10'])-set(dfkwbw['gwb_code_10']))]], ignore_index=True)
-dfkwbw = pd.concat([dfkwbw, dfkwb20.loc[dfkwb20['gwb_code_10'].isin(set(dfkwb20['gwb_code_10'])-set(dfkwbw['gwb_code_10']))]], ignore_index=True)
-dfkwbw = pd.concat([dfkwbw, dfkwb19.loc[dfkwb19['gwb_code_10'].isin(set(dfkwb19['gwb_code_10'])-set(dfkwbw['gwb_code_10']))]], ignore_index=True)
-dfkwbw = pd.concat([dfkwbw, dfkwb22.loc[dfkwb22['gwb_code_10'].isin(set(dfkwb22['gwb_code_10'])-set(dfkwbw['gwb_code_10']))]], ignore_index=True)
-# dfkwbw = pd.concat([dfkwbw, dfkwb23.loc[dfkwb23['gwb_code_10'].isin(set(dfkwb23['gwb_code_10'])-set(dfkwbw['gwb_code_10']))]], ignore_index=True)
-dfkwbw['gwb_code_8'] = dfkwbw['gwb_code_8'].astype(str)
-dfkwbw = dfkwbw.sort_values(by='gwb_code_8').reset_index(drop=True)
-dfkwbw['gwb_code_8'] = dfkwbw['gwb_code_8'].astype(int)
-
-cols_kwb = ['gwb_code_8','gm_naam','recs','a_inw','g_wozbag','g_ink_po','g_ink_pi','p_hh_110']
-dfkwbw = dfkwbw[cols_kwb]
-dfkwbw = dfkwbw[dfkwbw['recs']=='Wijk'].reset_index(drop=True)
-
-# clear memory
-del dfkwb22, dfkwb21, dfkwb20, dfkwb19
-gc.collect()
-
-
-#%% # Rename
-cols_rename = {'Toegankelijk voor mensen met een lichamelijke beperking':'Toegankelijkheid',
-               'CBS gemeentecode':'Gemeentecode'}
-dfwimsf.rename(columns=cols_rename, inplace=True)
-dfwimso.rename(columns=cols_rename, inplace=True)
-
-cols_rename = {'postcode':'PC6'}
-gdfpc6.rename(columns=cols_rename, inplace=True)
-
-cols_rename = {'Gemcode2022':'Gemeentecode','Gemcode2021':'Gemeentecode','Gemcode2020':'Gemeentecode','Gemcode2019':'Gemeentecode',
-               'Gemeente2022':'Gemeentecode','Gemeente2021':'Gemeentecode','Gemeente2020':'Gemeentecode','Gemeente2019':'Gemeentecode',
-               'Gemeentenaam2022':'Gemeentenaam','Gemeentenaam2021':'Gemeentenaam','Gemeentenaam2020':'Gemeentenaam','Gemeentenaam2019':'Gemeentenaam',
-               'Buurt2020':'Buurt','Buurt2021':'Buurt','Buurt2022':'Buurt','Buurt2019':'Buurt',
-               'Wijk2020':'Wijkcode','Wijk2021':'Wijkcode','Wijk2022':'Wijkcode','Wijk2019':'Wijkcode',
-               'wijkcode2022':'Wijkcode','wijkcode2021':'Wijkcode','wijkcode2020':'Wijkcode','Wijkcode2019':'Wijkcode',
-               'wijknaam2022':'Wijknaam','wijknaam2021':'Wijknaam','wijknaam2020':'Wijknaam','Wijknaam_2019K_NAAM':'Wijknaam'}
-mapgem22.rename(columns=cols_rename, inplace=True)
-mapwyk22.rename(columns=cols_rename, inplace=True)
-mapgwb22.rename(columns=cols_rename, inplace=True)
-mapgem21.rename(columns=cols_rename, inplace=True)
-mapwyk21.rename(columns=cols_rename, inplace=True)
-mapgwb21.rename(columns=cols_rename, inplace=True)
-mapgem20.rename(columns=cols_rename, inplace=True)
-mapwyk20.rename(columns=cols_rename, inplace=True)
-mapgwb20.rename(columns=cols_rename, inplace=True)
-mapgem19.rename(columns=cols_rename, inplace=True)
-mapwyk19.rename(columns=cols_rename, inplace=True)
-mapgwb19.rename(columns=cols_rename, inplace=True)
-
-cols_rename = {'gwb_code_8':'Wijkcode','gm_naam':'Gemeentenaam'}
-dfkwbw.rename(columns=cols_rename, inplace=True)
-
-
-#%% # Merge mapping
-mapgwb = mapgwb22.copy()
-mapgwb = pd.concat([mapgwb,mapgwb21]).drop_duplicates(subset=['PC6','Huisnummer'], keep='first').reset_index(drop=True)
-mapgwb = pd.concat([mapgwb,mapgwb20]).drop_duplicates(subset=['PC6','Huisnummer'], keep='first').reset_index(drop=True)
-mapgwb = pd.concat([mapgwb,mapgwb19]).drop_duplicates(subset=['PC6','Huisnummer'], keep='first').reset_index(drop=True)
-mapgem = mapgem22.copy()
-mapgem = pd.concat([mapgem,mapgem21]).drop_duplicates(subset=['Gemeentecode'], keep='first').reset_index(drop=True)
-mapgem = pd.concat([mapgem,mapgem20]).drop_duplicates(subset=['Gemeentecode'], keep='first').reset_index(drop=True)
-mapgem = pd.concat([mapgem,mapgem19]).drop_duplicates(subset=['Gemeentecode'], keep='first').reset_index(drop=True)
-mapwyk = mapwyk22.copy()
-mapwyk = pd.concat([mapwyk,mapwyk21]).drop_duplicates(subset=['Wijkcode'], keep='first').reset_index(drop=True)
-mapwyk = pd.concat([mapwyk,mapwyk20]).drop_duplicates(subset=['Wijkcode'], keep='first').reset_index(drop=True)
-mapwyk = pd.concat([mapwyk,mapwyk19]).drop_duplicates(subset=['Wijkcode'], keep='first').reset_index(drop=True)
-
-# clear memory
-del mapgwb19, mapgwb20, mapgwb21, mapgwb22
-del mapgem19, mapgem20, mapgem21, mapgem22
-del mapwyk19, mapwyk20, mapwyk21, mapwyk22
-gc.collect()
-
-
-#%% # Append information
-mapgwb = pd.merge(mapgwb, mapgem, on='Gemeentecode', how='left')
-mapgwb = pd.merge(mapgwb, mapwyk, on='Wijkcode', how='left')
+def stage_read(cfg, state):
+    cachesettings = cache_settings(cfg)
+
+    # stembureaus en verkiezingen
+    dfwimso = read_cached(pd.read_csv, datafile(cfg, 'subwms', 'fileWOR'), **cachesettings) # 2023, original downloaded version
+    dfwimsf = read_cached(pd.read_excel, datafile(cfg, 'subwms', 'fileWMS'), **cachesettings) # 2023, deduplicated checked final version WIMS
+
+    # CBS gegevens (with do_stream the grid is only read in the stream stage)
+    gdfbox = None
+    if not cfg['do_stream']:
+        gdfbox = read_cached(read_grid, grid_file(cfg), columns=cols_box, chunksize=cfg['grid_chunksize'], **cachesettings) # 2021
+    gdfpc6 = read_cached(gpd.read_file, datafile(cfg, 'subcbs', 'filePc6'), **cachesettings) # 2021
+    dfkwbs = {year: read_cached(pd.read_excel, datafile(cfg, 'subcbs', 'fileKWB%02d' % (year % 100)), decimal=',', **cachesettings)
+              for year in cfg['kwb_years']}
+
+    # mapping
+    mapgem23 = read_cached(pd.read_csv, datafile(cfg, 'submap', 'filemapGEM23'), delimiter='\t', encoding= 'unicode_escape', **cachesettings)
+    unsupported = [year for year in cfg['map_years'] if year not in readsettings_mapping]
+    if unsupported:
+        raise ValueError('map_years %s not supported, only %s (see readsettings_mapping and cols_rename_mapping)'
+                         % (unsupported, sorted(readsettings_mapping)))
+    mapgems, mapwyks = [], []
+    for year in cfg['map_years']: # in order of priority
+        mapgems.append( read_cached(pd.read_csv, datafile(cfg, 'submap', 'filemapGEM%02d' % (year % 100)), **readsettings_mapping[year], **cachesettings).rename(columns=cols_rename_mapping) )
+        mapwyks.append( read_cached(pd.read_csv, datafile(cfg, 'submap', 'filemapWYK%02d' % (year % 100)), **readsettings_mapping[year], **cachesettings).rename(columns=cols_rename_mapping) )
+
+    # merge mapping: per code the year with the highest priority
+    mapgem = merge_vintages(mapgems, 'Gemeentecode')
+    mapwyk = merge_vintages(mapwyks, 'Wijkcode')
+
+    # PC6 -> gemeente/wijk index from the house number mapping (2023 is not used)
+    mapfiles_gwb = [datafile(cfg, 'submap', 'filemapGWB%02d' % (year % 100)) for year in cfg['map_years']]
+    mapfiles_gem_wyk = [datafile(cfg, 'submap', 'file%s%02d' % (kind, year % 100)) for kind in ['mapGEM','mapWYK'] for year in cfg['map_years']]
+    pc6indexfile = os.path.join(cfg['cachepath'], 'pc6_index.npz')
+    pc6indexkey = files_key(mapfiles_gwb + mapfiles_gem_wyk)
+    pc6index = load_pc6_index(pc6indexfile, pc6indexkey) if (cfg['do_use_cache'] and not cfg['do_refresh_cache']) else None
+    if pc6index is None:
+        mapgwb = read_mapping_gwb(mapfiles_gwb, cols_rename_mapping, **cachesettings)
+        pc6index = build_pc6_index(mapgwb, mapgem, mapwyk, key=pc6indexkey)
+        if cfg['do_use_cache']:
+            save_pc6_index(pc6index, pc6indexfile)
+        del mapgwb
+
+    # clear memory
+    gc.collect()
+
+    # explore
+    if cfg['do_explore']:
+        print(dfwimsf.isna().sum())
+
+    return {'dfwimso': dfwimso, 'dfwimsf': dfwimsf, 'gdfbox': gdfbox, 'gdfpc6': gdfpc6, 'dfkwbs': dfkwbs,
+            'mapgem23': mapgem23, 'mapgem': mapgem, 'mapwyk': mapwyk, 'pc6index': pc6index}
 
 
 #%% # Clean
+def stage_clean(cfg, state):
+    dfwimso, dfwimsf, gdfpc6 = state['dfwimso'].copy(), state['dfwimsf'].copy(), state['gdfpc6'].copy()
 
-# replace -99997's
-gdfbox.replace(-99997, np.nan, inplace=True)
-gdfpc6.replace(-99997, np.nan, inplace=True)
-
-# replace GM from gemeentecode and leading 0
-dfwimsf['Gemeentecode'] = dfwimsf['Gemeentecode'].str.replace('GM','').astype(int)
-dfwimso['Gemeentecode'] = dfwimso['Gemeentecode'].str.replace('GM','').astype(int)
-
-# replace '.'
-dfkwbw.replace('.', 0, inplace=True)
-dfkwbw['Wijkcode'] = dfkwbw['Wijkcode'].astype(str)
-
-# postcode mapping is inclusive of house number, which we do not need
-todrop = {'Huisnummer','Buurt'}
-todrop = list(todrop.intersection(mapgwb.columns))
-mapgwb_nonum = (mapgwb.drop(columns=todrop).drop_duplicates()).sort_values(by=['PC6']) # removes duplicates ignoring house number
-mapgwb_nonum = mapgwb_nonum.drop_duplicates(subset='PC6', keep='first').reset_index(drop=True) # removes pc6's crossing borders
-# NOTE >>> 5355 (1.139%) postal codes cross municipality and/or wijk border, chosen to keep first
-
-# change type
-tofloat = ['a_inw','g_wozbag','g_ink_po','g_ink_pi','p_hh_110']
-dfkwbw[tofloat] = dfkwbw[tofloat].astype(float)
-
-
-#%% # Convert
-
-# datetime conversion
-dfwimsf['Openingstijd'] = pd.to_datetime(dfwimsf['Openingstijd'])
-dfwimsf['Sluitingstijd'] = pd.to_datetime(dfwimsf['Sluitingstijd'])
-dfwimsf['Openingsduur'] = round( (dfwimsf['Sluitingstijd'] - dfwimsf['Openingstijd'])/np.timedelta64(1,'h'),1 )
-
-# check opening hours
-Counter(dfwimsf['Openingsduur']).most_common()
-
-# new format
-do_save_new_format = 0
-if do_save_new_format:
-    filemapGWB_19_22 = 'GWB_mapping_19_to_22.xlsx'
-    mapgwb_nonum.to_excel(mypath + submap + filemapGWB_19_22, index=False)
-
-
-#%% # Features
-do_new_features = 0
-if do_new_features == 1:
-    dfwimsf['Openingsduur_korter'] = (dfwimsf['Openingsduur'] < 13.5)*1
-    dfwimsf['Openingsduur_langer'] = (dfwimsf['Openingsduur'] > 13.5)*1
-    dfwimsf['Openingsduur_afwijkend'] = (dfwimsf['Openingsduur'] != 13.5)*1
-
+    dfkwbs, pc6index = state['dfkwbs'], state['pc6index']
 
-#%% # Coordinate transformations
+    # check duplicates
+    if cfg['do_check_again']:
 
-# create geometry
-dfwimsf['geometry'] = gpd.points_from_xy(dfwimsf['X'],dfwimsf['Y'], crs='28992') # RD-coordinates
-dfwimsf = gpd.GeoDataFrame(dfwimsf).set_crs(28992)
+        # find cases with same coordinate (lat,lon) but different address (gem,pc6,str), and vice versa
+        check_indx = check_duplicates(dfwimsf, cols_address=['Gemeente','Straatnaam','Postcode'], cols_coordinate=['Latitude','Longitude'])
+        print('To check =', check_indx.sum())
 
-# create lat lon
-gdfbox['geometry_latlon'] = gdfbox['geometry'].to_crs(4326) # Lat-Lon coordinates
-gdfbox['geometry_latlon'] = gdfbox['geometry_latlon'].representative_point()
+        check_also = check_indx & (dfwimsf['check_deduplication'] != 1)
+        dfwimsf.loc[check_also, 'check_deduplication'] = 11
 
-# (Multi)Polygon to representative point
-gdfbox['geometry'] = gdfbox['geometry'].representative_point()
+    # find nearby stemlokalen with a similar address (different spelling, a few meters apart)
+    dfwimsf_near = None
+    if cfg['do_check_fuzzy']:
+        dfwimsf_near = find_near_duplicates(dfwimsf, radius=cfg['fuzzy_radius'], min_score=cfg['fuzzy_min_score'])
+        dfwimsf_near = dfwimsf[['_id','Gemeente','Naam stembureau']].join(dfwimsf_near, how='inner').sort_values(by='cluster', kind='stable')
+        print('Near duplicates =', len(dfwimsf_near), 'in', dfwimsf_near['cluster'].nunique(), 'clusters')
 
+    # select and rename
+    dfwimsf = select_wims(dfwimsf)
+    dfwimso = select_wims(dfwimso)
 
-#%% # Find or append municipality (gemeente)
+    # merge multiple years of KWB data: per gwb code the year with the highest priority (kept in kwb_jaar)
+    kwb_years = cfg['kwb_years'] # in order of priority
+    dfkwbw = merge_vintages([dfkwbs[year] for year in kwb_years], 'gwb_code_10', years=kwb_years, col_year='kwb_jaar')
 
-# find gemeente
-gdfpc6 = pd.merge(gdfpc6, mapgwb_nonum, how='left', on='PC6')
-cols_wanted = {'geometry','Gemeentecode','Gemeentenaam','Wijkcode','Wijknaam'}
-cols_wanted = list(cols_wanted.intersection(gdfpc6.columns))
-gdfbox = sjoin_nearest(gdfbox, gdfpc6[cols_wanted])
+    cols_kwb = ['gwb_code_8','gm_naam','recs','a_inw','g_wozbag','g_ink_po','g_ink_pi','p_hh_110','kwb_jaar']
+    dfkwbw = dfkwbw.loc[dfkwbw['recs']=='Wijk', cols_kwb]
+    dfkwbw = dfkwbw.sort_values(by='gwb_code_8', key=lambda codes: codes.astype(str), kind='stable').reset_index(drop=True) # as text
 
-# drop duplicates originating from sjoin_nearest (from identical distances?)
-gdfbox = gdfbox.drop_duplicates(subset=gdfbox.columns[0], keep='first').reset_index(drop=True)
-
-# drop index_right
-todrop = {'index_right'}
-gdfbox.drop(columns=todrop, inplace=True)
-
-# convert type
-toint = ['Gemeentecode','Wijkcode']
-gdfbox[toint] = gdfbox[toint].astype(int)
+    # rename
+    cols_rename = {'postcode':'PC6'}
+    gdfpc6.rename(columns=cols_rename, inplace=True)
 
-# sanity check
-gdfbox.loc[gdfbox['Gemeentenaam']=='Amsterdam', 'aantal_inwoners'].sum()    # as expected
-gdfbox.loc[gdfbox['Gemeentenaam']=='Tilburg', 'aantal_inwoners'].sum()      # as expected
-gdfbox.loc[gdfbox['Gemeentenaam']=='Eemsdelta', 'aantal_inwoners'].sum()    # as expected
-gdfbox.loc[gdfbox['Gemeentenaam']=='Appingedam', 'aantal_inwoners'].sum()   # as expected
-gdfbox.loc[gdfbox['Gemeentenaam']=='Loppersum', 'aantal_inwoners'].sum()    # as expected
-gdfbox.loc[gdfbox['Gemeentenaam']=='Simpelveld', 'aantal_inwoners'].sum()   # as expected
+    cols_rename = {'gwb_code_8':'Wijkcode','gm_naam':'Gemeentenaam'}
+    dfkwbw.rename(columns=cols_rename, inplace=True)
+
+    # replace -99997's
+    gdfpc6.replace(-99997, np.nan, inplace=True)
+
+    # stemlokalen without coordinates: from their address (PC6 + house number) offline, see geocode
+    missing_xy = dfwimsf[['X','Y']].isna().any(axis=1)
+    if missing_xy.any():
+        mapfiles_gwb = [datafile(cfg, 'submap', 'filemapGWB%02d' % (year % 100)) for year in cfg['map_years']]
+        mapgwb = read_mapping_gwb(mapfiles_gwb, cols_rename_mapping, **cache_settings(cfg))
+        addresses = dfwimsf.loc[missing_xy, ['Postcode','Huisnummer','Straatnaam']].rename(columns={'Postcode':'PC6'})
+        remote = remote_geocoder(cfg['geocoder']) if cfg['geocoder'] else None
+        located = geocode(addresses, gdfpc6, mapgwb, cache_file=os.path.join(cfg['cachepath'], 'geocode_cache.parquet'), remote=remote)
+        rd_to_latlon = Transformer.from_crs(28992, 4326, always_xy=True) # RD- to Lat-Lon coordinates
+        dfwimsf.loc[missing_xy, 'X'], dfwimsf.loc[missing_xy, 'Y'] = located['X'], located['Y']
+        dfwimsf.loc[missing_xy, 'Longitude'], dfwimsf.loc[missing_xy, 'Latitude'] = rd_to_latlon.transform(located['X'].to_numpy(), located['Y'].to_numpy())
+        if cfg['verbose']:
+            print('Geocoded =', Counter(located['bron'].fillna('not found')).most_common())
+        del mapgwb
+
+    # replace '.'
+    dfkwbw.replace('.', 0, inplace=True)
+    dfkwbw['Wijkcode'] = dfkwbw['Wijkcode'].astype(str)
+
+    # postcode mapping is inclusive of house number, which we do not need (the PC6 index has one row per PC6)
+    if cfg['verbose']:
+        print('PC6 crossing borders =', len(pc6index['cross_border']))
+    # NOTE >>> 5355 (1.139%) postal codes cross municipality and/or wijk border, chosen to keep first (year)
+
+    # change type
+    tofloat = ['a_inw','g_wozbag','g_ink_po','g_ink_pi','p_hh_110']
+    dfkwbw[tofloat] = dfkwbw[tofloat].astype(float)
+
+    # datetime conversion
+    dfwimsf['Openingstijd'] = pd.to_datetime(dfwimsf['Openingstijd'])
+    dfwimsf['Sluitingstijd'] = pd.to_datetime(dfwimsf['Sluitingstijd'])
+    dfwimsf['Openingsduur'] = round( (dfwimsf['Sluitingstijd'] - dfwimsf['Openingstijd'])/np.timedelta64(1,'h'),1 )
+
+    # check opening hours
+    if cfg['verbose'] > 1:
+        print(Counter(dfwimsf['Openingsduur']).most_common())
+
+    # new format
+    if cfg['do_save_new_format']:
+        filemapGWB_19_22 = 'GWB_mapping_19_to_22.xlsx'
+        lookup_pc6(pc6index, pd.Series(pc6index['pc6'], name='PC6')).reset_index().to_excel(os.path.join(cfg['mypath'], cfg['submap'], filemapGWB_19_22), index=False)
+
+    # features
+    if cfg['do_new_features'] == 1:
+        dfwimsf['Openingsduur_korter'] = (dfwimsf['Openingsduur'] < 13.5)*1
+        dfwimsf['Openingsduur_langer'] = (dfwimsf['Openingsduur'] > 13.5)*1
+        dfwimsf['Openingsduur_afwijkend'] = (dfwimsf['Openingsduur'] != 13.5)*1
+
+    # PC6 areas with their gemeente and wijk, to find those of the boxes
+    gdfpc6 = gdfpc6.join( lookup_pc6(pc6index, gdfpc6['PC6']) )
+    cols_wanted = {'geometry','Gemeentecode','Gemeentenaam','Wijkcode','Wijknaam'}
+    gdfpc6 = gdfpc6[list(cols_wanted.intersection(gdfpc6.columns))]
+
+    # slim working frame of the boxes: the id, the columns used later and the representative point of every box
+    # as plain X/Y (RD-coordinates) instead of the polygon, see read_grid (with do_stream: per part in stage_stream)
+    gdfbox = None
+    if state['gdfbox'] is not None:
+        gdfbox = prepare_boxes(cfg, state['gdfbox'], gdfpc6)
+
+        # sanity check
+        if cfg['verbose'] > 1:
+            print_sanity(gdfbox, 'Gemeentenaam') # as expected
+
+    # the mapping is passed on, so the later stages can start from a checkpoint of this stage
+    return {'dfwimso': dfwimso, 'dfwimsf': dfwimsf, 'dfwimsf_near': dfwimsf_near, 'gdfbox': gdfbox, 'gdfpc6': gdfpc6, 'dfkwbw': dfkwbw,
+            'mapgem23': state['mapgem23'], 'mapwyk': state['mapwyk'], 'pc6index': pc6index}
+
+def prepare_boxes(cfg, gdfbox, gdfpc6):
+    # the boxes (all or one part of the grid) with lat/lon and the gemeente/wijk of the nearest PC6 area
+    gdfbox = gdfbox.copy()
+
+    # replace -99997's
+    gdfbox.replace(-99997, np.nan, inplace=True)
+
+    # create lat lon of the box points
+    rd_to_latlon = Transformer.from_crs(28992, 4326, always_xy=True) # RD- to Lat-Lon coordinates
+    gdfbox['Longitude'], gdfbox['Latitude'] = rd_to_latlon.transform(gdfbox['X'].to_numpy(), gdfbox['Y'].to_numpy())
+
+    # find gemeente: PC6 area nearest to the box point (only here Shapely points are needed)
+    gdfbox_pc6 = []
+    for start in range(0, len(gdfbox), cfg['grid_chunksize']): # in chunks, for fine grids
+        chunk = gdfbox.iloc[start:start + cfg['grid_chunksize']]
+        points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(chunk['X'], chunk['Y']), index=chunk.index, crs=gdfpc6.crs)
+        gdfbox_pc6.append( sjoin_nearest(points, gdfpc6) )
+    gdfbox_pc6 = pd.concat(gdfbox_pc6)
+
+    # drop duplicates originating from sjoin_nearest (PC6 areas at identical distances): the first PC6 area of the file
+    gdfbox_pc6 = gdfbox_pc6.sort_values(by='index_right', kind='stable').sort_index(kind='stable')
+    gdfbox_pc6 = gdfbox_pc6[~gdfbox_pc6.index.duplicated(keep='first')]
+
+    # drop geometry and index_right
+    todrop = ['geometry','index_right']
+    gdfbox = gdfbox.join(gdfbox_pc6.drop(columns=todrop), how='inner').reset_index(drop=True)
+
+    # convert type (compact)
+    toint = ['Gemeentecode','Wijkcode']
+    gdfbox[toint] = gdfbox[toint].astype('int32')
+    tocategory = ['Gemeentenaam','Wijknaam']
+    gdfbox[tocategory] = gdfbox[tocategory].astype('category')
+    return gdfbox
 
 
 #%% # Find nearest
-nearest_method = 2
-
-# without municipality border limitation
-if nearest_method == 1:
-    # sjoin
-    joincols = ['geometry','Gemeente','Gemeentecode']
-    cols_rename = {'Gemeentecode':'GemeentecodeWIMS'}
-    # gdfpc6 = sjoin_nearest(gdfpc6, dfwimsf[joincols].rename(columns=cols_rename), how='left')
-    gdfboxn = sjoin_nearest(gdfbox, dfwimsf[joincols].rename(columns=cols_rename), how='left')
-
-    # drop duplicates originating from sjoin_nearest
-    gdfboxn = gdfboxn.drop_duplicates(subset=gdfboxn.columns[0], keep='first').reset_index(drop=True)
-
-    # change name for clarity
-    cols_rename = {'Gemeente':'Gemeente_nearest_SL','GemeentecodeWIMS':'Gemeentecode_nearest_SL'}
-    gdfpc6.rename(columns=cols_rename, inplace=True)
-    gdfboxn.rename(columns=cols_rename, inplace=True)
-
-# with municipality border limitation
-if nearest_method == 2:
-    gdfboxn = gdfbox.copy()
-    lijst_gemeentecodes = sorted(list(set( gdfbox['Gemeentecode'].dropna().astype(int) )))
-    subsetcols = ['geometry','Gemeente_nearest_SL','Gemeentecode_nearest_SL','index_right']
-
-    for gemeentecode in sorted(lijst_gemeentecodes):
-        # condition
-        condition1 = gdfbox['Gemeentecode']==gemeentecode
-        condition2 = dfwimsf['Gemeentecode']==gemeentecode
-        gdfbox_sub = gdfbox[condition1].copy()
-        dfwimsf_sub = dfwimsf[condition2].copy()
-
-        # change name for clarity
-        cols_rename = {'Gemeente':'Gemeente_nearest_SL','Gemeentecode':'Gemeentecode_nearest_SL'}
-        dfwimsf_sub.rename(columns=cols_rename, inplace=True)
-
-        # find nearest gemeente
-        gdfbox_sub = sjoin_nearest(gdfbox_sub, dfwimsf_sub[ subsetcols[0:3] ], how='left')
-
-        # drop duplicates originating from sjoin_nearest
-        gdfbox_sub = gdfbox_sub.drop_duplicates(subset=gdfbox_sub.columns[0], keep='last')
-
-        # put back
-        gdfboxn.loc[condition1, subsetcols[1]] = gdfbox_sub[subsetcols[1]].values
-        gdfboxn.loc[condition1, subsetcols[2]] = gdfbox_sub[subsetcols[2]].values
-        gdfboxn.loc[condition1, subsetcols[3]] = gdfbox_sub[subsetcols[3]].values
-
-    # fill remaining without border limitation
-    conditionnan = gdfboxn['Gemeente_nearest_SL'].isna()
-    gdfbox_sub = gdfboxn[conditionnan]
-
-    joincols = ['geometry','Gemeente','Gemeentecode']
-    cols_rename = {'Gemeente':'Gemeente_nearest_SL','Gemeentecode':'Gemeentecode_nearest_SL'}
-    cols_drop = {'Gemeente_nearest_SL', 'Gemeentecode_nearest_SL','index_right'}
-    gdfbox_sub = sjoin_nearest(gdfbox_sub.drop(columns=cols_drop), dfwimsf[joincols].rename(columns=cols_rename), how='left')
-
-    # drop duplicates originating from sjoin_nearest
-    gdfbox_sub = gdfbox_sub.drop_duplicates(subset=gdfbox_sub.columns[0], keep='last')
-
-    # put back
-    gdfboxn.loc[conditionnan, subsetcols[1]] = gdfbox_sub[subsetcols[1]].values
-    gdfboxn.loc[conditionnan, subsetcols[2]] = gdfbox_sub[subsetcols[2]].values
-    gdfboxn.loc[conditionnan, subsetcols[3]] = gdfbox_sub[subsetcols[3]].values
-
-# check missing
-gdfboxn.isna().sum() # missings can come from mismatch in herindeling gemeente in method 2
-
-# sanity check
-gdfboxn.loc[gdfboxn['Gemeente_nearest_SL']=='Amsterdam', 'aantal_inwoners'].sum()   # as expected
-gdfboxn.loc[gdfboxn['Gemeente_nearest_SL']=='Tilburg', 'aantal_inwoners'].sum()     # as expected
-gdfboxn.loc[gdfboxn['Gemeente_nearest_SL']=='Eemsdelta', 'aantal_inwoners'].sum()   # as expected
-gdfboxn.loc[gdfboxn['Gemeente_nearest_SL']=='Appingedam', 'aantal_inwoners'].sum()  # as expected
-gdfboxn.loc[gdfboxn['Gemeente_nearest_SL']=='Loppersum', 'aantal_inwoners'].sum()   # as expected
-gdfboxn.loc[gdfboxn['Gemeente_nearest_SL']=='Simpelveld', 'aantal_inwoners'].sum()  # as expected
-
-
-#%% # Find distances (slowest part)
-gdfboxn['distance_nearest_SL'] = np.nan
-for index in gdfboxn.index:
-    gdfi = gdfboxn.loc[index:index]
-    if gdfi['index_right'].values[0] > 0:
-        wimsi = dfwimsf.loc[gdfi['index_right']]
-        calculateddistance = gdfi.distance( wimsi, align=False )
-        gdfboxn.loc[index, 'distance_nearest_SL'] = calculateddistance.values[0]
-
-# check mean and median distance
-check1 = weighted_average(gdfboxn, 'distance_nearest_SL', 'aantal_inwoners')
-check2 = weighted_median(gdfboxn, 'distance_nearest_SL', 'aantal_inwoners')
-print('Mean distance =', check1)
-print('Median distance =', check2)
-
-# clear memory
-gc.collect()
-
-
-#%% # Organize afstanden on gemeente level
-cols_interest = ['gemeente','gemeentecode','inwoners','woningwaarde','uitkering','dist_mean','dist_median']
-df_afstanden_g = pd.DataFrame(columns=cols_interest)
-
-lijst_gemeentecodes = sorted(list(set( gdfboxn['Gemeentecode'].dropna().astype(int) ))) # from gdfbox, i.e. 2021
-lijst_gemeentecodes = sorted(list(set( gdfboxn['Gemeentecode_nearest_SL'].dropna().astype(int) ))) # from wims, i.e. 2023
-lijst_gemeentecodes = sorted(list(set( mapgem23['GM_CODE'].str.replace('GM','').astype(int) ))) # from gemeente mapping 2023
-gemcounter = 0
-nmissing_g = 0
-for gemeentecode in sorted(lijst_gemeentecodes):
-    condition = gdfboxn['Gemeentecode_nearest_SL']==gemeentecode
-    if condition.sum() > 0:
-        ii = gemcounter
-        gdfbox_sub = gdfboxn[condition].copy()
-        df_afstanden_g.loc[ii, 'gemeente'] = gdfbox_sub['Gemeente_nearest_SL'].values[0] # or: 'Gemeentenaam'
-        df_afstanden_g.loc[ii, 'gemeentecode'] = gdfbox_sub['Gemeentecode_nearest_SL'].values[0] # or: gemeentecode, 'Gemeentecode'
-        df_afstanden_g.loc[ii, 'inwoners'] = gdfbox_sub['aantal_inwoners'].sum(min_count=1)
-        df_afstanden_g.loc[ii, 'woningwaarde'] = gdfbox_sub['gemiddelde_woz_waarde_woning'].mean()
-        df_afstanden_g.loc[ii, 'uitkering'] = gdfbox_sub['aantal_personen_met_uitkering_onder_aowlft'].sum(min_count=1)
-        df_afstanden_g.loc[ii, 'dist_mean'] = weighted_average(gdfbox_sub, 'distance_nearest_SL', 'aantal_inwoners')
-        df_afstanden_g.loc[ii, 'dist_median'] = weighted_median(gdfbox_sub, 'distance_nearest_SL', 'aantal_inwoners')
-        gemcounter += 1
+def find_nearest_incremental(cfg, gdfbox, dfwimsf, by=None):
+    # find_nearest, with do_incremental from the result of the run before (<cachepath>/nearest_previous.pkl) when
+    # that was for the same boxes and nearest_method: only the boxes affected by the changed stemlokalen are searched
+    # again, see update_nearest
+    if not cfg['do_incremental']:
+        return find_nearest(gdfbox, dfwimsf, by=by, col_id='_id', workers=cfg['n_workers'])
+    cols_box_key = [gdfbox.columns[0],'X','Y','Gemeentecode']
+    boxes_key = hashlib.md5(pd.util.hash_pandas_object(gdfbox[cols_box_key], index=False).to_numpy().tobytes()).hexdigest()
+    previousfile = os.path.join(cfg['cachepath'], 'nearest_previous.pkl')
+    previous = load_checkpoint(previousfile)
+    if (previous is not None) and (previous['boxes_key'] == boxes_key) and (previous['nearest_method'] == cfg['nearest_method']):
+        nearest, nredo = update_nearest(gdfbox, dfwimsf, previous['nearest'], previous['dfwimsf'], by=by, workers=cfg['n_workers'])
+        print('Nearest searched again for %d of %d boxes' % (nredo, len(gdfbox)))
     else:
-        nongem = gdfboxn.loc[ gdfboxn['Gemeentecode']==gemeentecode, 'Gemeentenaam' ].values[0]
-        print('...Warning, this gemeente has no distances:', gemeentecode, nongem)
-        nmissing_g += 1
-
-# save the distances to a file
-if do_save_distances == 1:
-    savename = 'distances_on_gemeentelevel.xlsx'
-    df_afstanden_g.to_excel(anpath + subglv + savename, index=False)
-
-# change type
-# tofloat = ['inwoners','dist_mean','dist_median']
-# df_afstanden_g[tofloat] = df_afstanden_g[tofloat].astype(float)
-
-# check
-df_afstanden_g.isna().sum()
-
-
-#%% # Organize afstanden on wijk level
-cols_interest = ['Gemeente','Gemeentecode','Wijk','Wijkcode','inwoners','woningwaarde','uitkering','dist_mean','dist_median']
-df_afstanden_w = pd.DataFrame(columns=cols_interest)
-
-lijst_wijkcodes = sorted(list(set( gdfboxn['Wijkcode'].dropna() ))) # from gdfbox i.e. 2021
-lijst_wijkcodes = sorted(list(set( mapgwb['Wijkcode'].dropna() ))) # from gwb i.e. 2022--2019
-wijkcounter = 0
-nmissing_wk = 0
-for wijkcode in sorted(lijst_wijkcodes):
-    condition = gdfboxn['Wijkcode']==wijkcode
-    if condition.sum() > 0:
-        ii = wijkcounter
-        gdfbox_sub = gdfboxn[condition].copy()
-        df_afstanden_w.loc[ii, 'Gemeente'] = gdfbox_sub['Gemeentenaam'].values[0] # or: 'Gemeente_nearest_SL'
-        df_afstanden_w.loc[ii, 'Gemeentecode'] = gdfbox_sub['Gemeentecode'].values[0] # or: 'Gemeentecode_nearest_SL'
-        df_afstanden_w.loc[ii, 'Wijk'] = gdfbox_sub['Wijknaam'].values[0]
-        df_afstanden_w.loc[ii, 'Wijkcode'] = str(wijkcode) # or: 'Wijkcode'
-        df_afstanden_w.loc[ii, 'inwoners'] = gdfbox_sub['aantal_inwoners'].sum(min_count=1)
-        df_afstanden_w.loc[ii, 'woningwaarde'] = gdfbox_sub['gemiddelde_woz_waarde_woning'].mean()
-        df_afstanden_w.loc[ii, 'uitkering'] = gdfbox_sub['aantal_personen_met_uitkering_onder_aowlft'].sum(min_count=1)
-        df_afstanden_w.loc[ii, 'dist_mean'] = weighted_average(gdfbox_sub, 'distance_nearest_SL', 'aantal_inwoners')
-        df_afstanden_w.loc[ii, 'dist_median'] = weighted_median(gdfbox_sub, 'distance_nearest_SL', 'aantal_inwoners')
-        wijkcounter += 1
-    else:
-        nonwyk = mapwyk.loc[mapwyk['Wijkcode']==wijkcode, 'Wijknaam'].values[0]
-        if verbose > 1:
-            print('...Warning, this wijk has no distances:', wijkcode, nonwyk)
-        nmissing_wk += 1
-
-# Add kerncijfers on Wijk level
-mergecols = ['Wijkcode','a_inw','g_wozbag','g_ink_po','g_ink_pi','p_hh_110']
-df_afstanden_w_ = pd.merge(df_afstanden_w, dfkwbw[mergecols], how='left', on='Wijkcode') # we will not use additional information
-
-# save the distances to a file
-if do_save_distances == 1:
-    savename = 'distances_on_wijklevel.xlsx'
-    df_afstanden_w.to_excel(anpath + subwlv + savename, index=False)
-
-# change type
-# tofloat = ['inwoners','dist_mean','dist_median']
-# df_afstanden_w[tofloat] = df_afstanden_w[tofloat].astype(float)
-# df_afstanden_w_[tofloat] = df_afstanden_w_[tofloat].astype(float)
-
-# check
-df_afstanden_w.isna().sum()
+        nearest = find_nearest(gdfbox, dfwimsf, by=by, col_id='_id', workers=cfg['n_workers'])
+    cols_sl = ['_id','X','Y','Gemeente','Gemeentecode']
+    save_checkpoint({'boxes_key': boxes_key, 'nearest_method': cfg['nearest_method'], 'nearest': nearest, 'dfwimsf': dfwimsf[cols_sl]}, previousfile)
+    return nearest
+
+def stage_nearest(cfg, state):
+    gdfbox, dfwimsf = state['gdfbox'], state['dfwimsf']
+    nearest_method = cfg['nearest_method']
+
+    # without municipality border limitation (also gives the distances)
+    if nearest_method == 1:
+        gdfboxn = gdfbox.join( find_nearest_incremental(cfg, gdfbox, dfwimsf) )
+
+    # with municipality border limitation (also gives the distances)
+    if nearest_method == 2:
+        gdfboxn = gdfbox.join( find_nearest_incremental(cfg, gdfbox, dfwimsf, by='Gemeentecode') )
+
+        # benchmark workers
+        if cfg['do_benchmark']:
+            nearest_serial = find_nearest(gdfbox, dfwimsf, by='Gemeentecode', col_id='_id', workers=1)
+            for workers in sorted(set([1, 2, 4, 8, os.cpu_count()])):
+                if workers > os.cpu_count():
+                    continue
+                t0 = time.perf_counter()
+                nearest_workers = find_nearest(gdfbox, dfwimsf, by='Gemeentecode', col_id='_id', workers=workers)
+                t1 = time.perf_counter()
+                print('Nearest with %2d workers = %.3f s, identical = %s' % (workers, t1-t0, nearest_workers.equals(nearest_serial)))
+
+    # over the road network, without municipality border limitation (also gives the distances)
+    if nearest_method == 3:
+        gdfboxn = gdfbox.join( find_nearest_network(gdfbox, dfwimsf, load_network(cfg, dfwimsf), workers=cfg['n_workers']) )
+
+        # compare with the straight line distances
+        if cfg['verbose']:
+            straight = gdfbox.join( find_nearest(gdfbox, dfwimsf, col_id='_id', workers=cfg['n_workers']) )
+            detour = weighted_average(gdfboxn, 'distance_nearest_SL', 'aantal_inwoners') / weighted_average(straight, 'distance_nearest_SL', 'aantal_inwoners')
+            print('Network / straight line distance = %.2f' % detour)
+
+    # the k nearest stemlokalen anywhere, e.g. how far the inhabitants have to go when their nearest one closes
+    if cfg['k_nearest'] > 1:
+        gdfboxn = gdfboxn.join( find_k_nearest(gdfbox, dfwimsf, k=cfg['k_nearest'], col_id='_id', workers=cfg['n_workers']) )
+
+    # check missing
+    if cfg['verbose'] > 1:
+        print(gdfboxn.isna().sum()) # missings can come from mismatch in herindeling gemeente in method 2
+
+        # sanity check
+        print_sanity(gdfboxn, 'Gemeente_nearest_SL') # as expected
+
+    return {'gdfboxn': gdfboxn}
+
+
+#%% # Find distances
+def stage_distances(cfg, state):
+    gdfboxn, dfwimsf = state['gdfboxn'], state['dfwimsf']
+    if 'distance_nearest_SL' not in gdfboxn.columns: # find_nearest already gives them
+        gdfboxn = gdfboxn.copy()
+        gdfboxn['distance_nearest_SL'] = find_distances(gdfboxn, dfwimsf)
+
+    # check mean and median distance
+    check1 = weighted_average(gdfboxn, 'distance_nearest_SL', 'aantal_inwoners')
+    check2 = weighted_median(gdfboxn, 'distance_nearest_SL', 'aantal_inwoners')
+    print('Mean distance =', check1)
+    print('Median distance =', check2)
+
+    # benchmark distances
+    if cfg['do_benchmark']:
+        t0 = time.perf_counter()
+        distances_loop = find_distances_loop(gdfboxn, dfwimsf)
+        t1 = time.perf_counter()
+        distances_vect = find_distances(gdfboxn, dfwimsf)
+        t2 = time.perf_counter()
+        print('Loop       = %.2f s' % (t1-t0))
+        print('Vectorized = %.4f s' % (t2-t1))
+        print('Speedup    = %.0fx' % ((t1-t0)/(t2-t1)))
+        print('Identical  =', np.array_equal(distances_loop.values, distances_vect.values, equal_nan=True))
+
+    return {'gdfboxn': gdfboxn}
+
+
+#%% # Compare elections
+def stage_compare(cfg, state):
+    # the distances for several stemlokalen datasets (elections, or the original and cleaned WIMS) on the same boxes:
+    # the prepared boxes, the PC6 mapping and the road network are shared, only the nearest search is per election
+    elections = cfg['elections'] # {name: 'dfwimso', 'dfwimsf' or a key of [files] in subwms}
+    if not elections:
+        return {'df_compare_g': None, 'df_compare_w': None}
+    gdfbox = state['gdfbox']
+    if gdfbox is None:
+        raise ValueError('Comparing elections needs all boxes at once, not with do_stream')
+    network = read_network(cfg) if cfg['nearest_method'] == 3 else None
+
+    tables_g, tables_w = {}, {}
+    for name, source in elections.items():
+        if source in ['dfwimso','dfwimsf']:
+            dfwims = state[source]
+        else:
+            filename = datafile(cfg, 'subwms', source)
+            reader = pd.read_csv if filename.lower().endswith('.csv') else pd.read_excel
+            dfwims = select_wims(read_cached(reader, filename, **cache_settings(cfg)))
+        missing_xy = dfwims[['X','Y']].isna().any(axis=1).sum()
+        if missing_xy:
+            print('...Warning, %s: %d stemlokalen without coordinates are left out' % (name, missing_xy))
+        network_sl = load_network(cfg, dfwims, network) if network is not None else None
+        gdfboxn = gdfbox.join( nearest_stemlokalen(cfg, gdfbox, dfwims, network_sl) )
+
+        # per gemeente and wijk of the boxes, so the codes are the same for all elections
+        tables_g[name] = level_distances(gdfboxn, 'Gemeentecode')
+        tables_w[name] = level_distances(gdfboxn, 'Wijkcode')
+        if cfg['verbose']:
+            print('%s: %d stemlokalen, mean distance = %.1f' % (name, len(dfwims), weighted_average(gdfboxn, 'distance_nearest_SL', 'aantal_inwoners')))
+
+    names_g = gdfbox.drop_duplicates(subset='Gemeentecode').set_index('Gemeentecode')[['Gemeentenaam']]
+    df_compare_g = names_g.join(compare_distances(tables_g), how='right').rename_axis('Gemeentecode').reset_index()
+    names_w = gdfbox.drop_duplicates(subset='Wijkcode').set_index('Wijkcode')[['Gemeentenaam','Gemeentecode','Wijknaam']]
+    df_compare_w = names_w.join(compare_distances(tables_w), how='right').rename_axis('Wijkcode').reset_index()
+    return {'df_compare_g': df_compare_g, 'df_compare_w': df_compare_w}
+
+
+#%% # Organize afstanden
+def stage_aggregate(cfg, state):
+    gdfboxn, mapgem23, mapwyk, pc6index, dfkwbw = state['gdfboxn'], state['mapgem23'], state['mapwyk'], state['pc6index'], state['dfkwbw']
+    dist_quantiles = cfg['dist_quantiles']
+    means_k = {'distance_SL_%d' % r: 'dist_mean_%d' % r for r in range(2, cfg['k_nearest']+1)} # to the r-th nearest stemlokaal
+
+    # gemeente level
+    # from gdfbox, i.e. 2021: gdfboxn['Gemeentecode'], from wims, i.e. 2023: gdfboxn['Gemeentecode_nearest_SL']
+    lijst_gemeentecodes = sorted(list(set( mapgem23['GM_CODE'].str.replace('GM','').astype(int) ))) # from gemeente mapping 2023
+    df_afstanden_g, missing_g = aggregate_distances(gdfboxn, 'Gemeentecode_nearest_SL', lijst_gemeentecodes,
+                                                    cols_first={'Gemeente_nearest_SL':'gemeente'}, quantiles=dist_quantiles, means=means_k) # or: 'Gemeentenaam'
+    gemeentenamen = gdfboxn.drop_duplicates(subset='Gemeentecode').set_index('Gemeentecode')['Gemeentenaam']
+
+    # wijk level
+    # from gdfbox i.e. 2021: gdfboxn['Wijkcode']
+    lijst_wijkcodes = sorted(pc6index['wijkcodes'].tolist()) # from gwb i.e. 2022--2019
+    df_afstanden_w, missing_wk = aggregate_distances(gdfboxn, 'Wijkcode', lijst_wijkcodes,
+                                                     cols_first={'Gemeentenaam':'Gemeente','Gemeentecode':'Gemeentecode','Wijknaam':'Wijk'},
+                                                     quantiles=dist_quantiles, means=means_k) # or: '..._nearest_SL'
+
+    # distance distribution per gemeente/wijk combination, for the histogram and other questions later on
+    dist_cube = distance_cube(gdfboxn, ['Gemeentecode','Gemeentecode_nearest_SL','Wijkcode'],
+                              bin_width=cfg['cube_bin_width'], max_distance=cfg['cube_max_distance'])
+
+    return organize_afstanden(cfg, df_afstanden_g, missing_g, gemeentenamen, df_afstanden_w, missing_wk, mapwyk, dfkwbw, dist_cube)
+
+def organize_afstanden(cfg, df_afstanden_g, missing_g, gemeentenamen, df_afstanden_w, missing_wk, mapwyk, dfkwbw, dist_cube):
+    # the afstanden tables on gemeente and wijk level in their final form (from stage_aggregate or stage_stream)
+    dist_quantiles = cfg['dist_quantiles']
+
+    # gemeente level
+    cols_interest = ['gemeente','gemeentecode','inwoners','woningwaarde','uitkering','dist_mean','dist_median']
+    cols_interest += ['dist_p%d' % round(quantile*100) for quantile in dist_quantiles]
+    cols_interest += [col for col in df_afstanden_g.columns if col.startswith('dist_mean_')] # k_nearest
+    df_afstanden_g = df_afstanden_g.rename_axis('gemeentecode').reset_index()[cols_interest] # or: 'Gemeentecode'
+    for gemeentecode in missing_g:
+        print('...Warning, this gemeente has no distances:', gemeentecode, gemeentenamen.get(gemeentecode))
+
+    # wijk level
+    cols_interest = ['Gemeente','Gemeentecode','Wijk','Wijkcode','inwoners','woningwaarde','uitkering','dist_mean','dist_median']
+    cols_interest += ['dist_p%d' % round(quantile*100) for quantile in dist_quantiles]
+    cols_interest += [col for col in df_afstanden_w.columns if col.startswith('dist_mean_')] # k_nearest
+    df_afstanden_w['Wijkcode'] = df_afstanden_w.index.astype(str)
+    df_afstanden_w = df_afstanden_w.reset_index(drop=True)[cols_interest]
+    if cfg['verbose'] > 1:
+        wijknamen = mapwyk.drop_duplicates(subset='Wijkcode').set_index('Wijkcode')['Wijknaam']
+        for wijkcode in missing_wk:
+            print('...Warning, this wijk has no distances:', wijkcode, wijknamen.get(wijkcode))
+
+    # Add kerncijfers on Wijk level
+    mergecols = ['Wijkcode','a_inw','g_wozbag','g_ink_po','g_ink_pi','p_hh_110']
+    df_afstanden_w_ = pd.merge(df_afstanden_w, dfkwbw[mergecols], how='left', on='Wijkcode') # we will not use additional information
+
+    # check
+    if cfg['verbose'] > 1:
+        print(df_afstanden_g.isna().sum())
+        print(df_afstanden_w.isna().sum())
+
+    return {'df_afstanden_g': df_afstanden_g, 'df_afstanden_w': df_afstanden_w, 'df_afstanden_w_': df_afstanden_w_, 'dist_cube': dist_cube}
+
+
+#%% # Stream
+def stage_stream(cfg, state):
+    dfwimsf, gdfpc6, mapgem23, mapwyk, pc6index, dfkwbw = state['dfwimsf'], state['gdfpc6'], state['mapgem23'], state['mapwyk'], state['pc6index'], state['dfkwbw']
+
+    # nearest, distances and aggregate for one part of the grid (grid_chunksize boxes) at a time: of every part
+    # only the running sums per gemeente and wijk and the distance cube are kept, so the memory does not grow
+    # with the grid. The medians and quantiles come from the cube (within cube_bin_width of the exact values).
+    cols_first_g = {'Gemeente_nearest_SL':'gemeente'}
+    cols_first_w = {'Gemeentenaam':'Gemeente','Gemeentecode':'Gemeentecode','Wijknaam':'Wijk'}
+    network_sl = load_network(cfg, dfwimsf) if cfg['nearest_method'] == 3 else None
+    sums_g, sums_w, dist_cube = None, None, None
+    for gdfbox in iter_grid(grid_file(cfg), cols_box, cfg['grid_chunksize']):
+        gdfbox = prepare_boxes(cfg, gdfbox, gdfpc6)
+        gdfboxn = gdfbox.join( nearest_stemlokalen(cfg, gdfbox, dfwimsf, network_sl) )
+        sums_g = distance_sums(gdfboxn, 'Gemeentecode_nearest_SL', cols_first_g, sums=sums_g)
+        sums_w = distance_sums(gdfboxn, 'Wijkcode', cols_first_w, sums=sums_w)
+        dist_cube = add_cubes(dist_cube, distance_cube(gdfboxn, ['Gemeentecode','Gemeentecode_nearest_SL','Wijkcode'],
+                                                       bin_width=cfg['cube_bin_width'], max_distance=cfg['cube_max_distance']))
+        del gdfbox, gdfboxn
+        gc.collect()
+
+    # check mean and median distance
+    check = cube_table(dist_cube)
+    print('Mean distance =', check['dist_mean'].iloc[0])
+    print('Median distance =', check['dist_p50'].iloc[0])
+
+    # gemeente level
+    lijst_gemeentecodes = sorted(list(set( mapgem23['GM_CODE'].str.replace('GM','').astype(int) ))) # from gemeente mapping 2023
+    df_afstanden_g, missing_g = distance_table(sums_g, lijst_gemeentecodes, dist_cube, cols_first_g, quantiles=cfg['dist_quantiles'])
+    gemeentenamen = sums_w.drop_duplicates(subset='Gemeentecode').set_index('Gemeentecode')['Gemeentenaam']
+
+    # wijk level
+    lijst_wijkcodes = sorted(pc6index['wijkcodes'].tolist()) # from gwb i.e. 2022--2019
+    df_afstanden_w, missing_wk = distance_table(sums_w, lijst_wijkcodes, dist_cube, cols_first_w, quantiles=cfg['dist_quantiles'])
+
+    return organize_afstanden(cfg, df_afstanden_g, missing_g, gemeentenamen, df_afstanden_w, missing_wk, mapwyk, dfkwbw, dist_cube)
+
+
+#%% # Save afstanden
+def stage_save(cfg, state):
+    # save the distances to a file (also when they come from a checkpoint)
+    if cfg['do_save_distances'] == 1:
+        savename = 'distances_on_gemeentelevel.xlsx'
+        state['df_afstanden_g'].to_excel(os.path.join(cfg['anpath'], cfg['subglv'], savename), index=False)
+        savename = 'distances_on_wijklevel.xlsx'
+        state['df_afstanden_w'].to_excel(os.path.join(cfg['anpath'], cfg['subwlv'], savename), index=False)
+        savename = 'distance_cube.npz' # see cube_table
+        np.savez_compressed(os.path.join(cfg['anpath'], savename), **state['dist_cube'])
+        if state.get('df_compare_g') is not None: # with elections, see stage_compare and stage_inputs
+            savename = 'distances_compare_gemeentelevel.xlsx'
+            state['df_compare_g'].to_excel(os.path.join(cfg['anpath'], cfg['subglv'], savename), index=False)
+            savename = 'distances_compare_wijklevel.xlsx'
+            state['df_compare_w'].to_excel(os.path.join(cfg['anpath'], cfg['subwlv'], savename), index=False)
+
+    # save the near duplicates to check
+    if state['dfwimsf_near'] is not None:
+        savename = 'near_duplicates_stemlokalen.xlsx'
+        state['dfwimsf_near'].to_excel(os.path.join(cfg['anpath'], savename))
+    return {}
 
 
 #%% # Plots
-mycol = '#3f88c5' #'navy'
-myfontsize = 15
-tickfontsize = 15
-mymarkersz = 7 # default = 6
-myfigsize = (10,5) # default = 8,6
-plt.rcParams['axes.formatter.min_exponent'] = 5 # default = 0
-
-fontdict = {
-    'fontname': "Corbel",
-    'fontsize': 15
-}
-
-# histogram
-selected_boxes = gdfboxn.loc[gdfboxn['aantal_inwoners']>5,'distance_nearest_SL']
-
-plt.figure(figsize=myfigsize)
-#plt.hist(selected_boxes, bins=10, range=[0,3000], alpha=0.9, rwidth=0.85, edgecolor='black', color = mycol)
-plt.hist(selected_boxes, bins=10, range=[0,3000], alpha=0.9, rwidth=0.85, color = mycol)
-plt.xlabel("Afstand (meter)", labelpad=10, fontdict=fontdict)
-plt.ylabel("Aantal gebieden", labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.tight_layout()
-
-
-
-savefile = "plot_distances_histogram_alteast_5_pop.png"
-plt.savefig(anpath + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-#plt.savefig(anpath + savefile, bbox_inches='tight', transparent=False, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-# wijklevel - regular
-plt.figure(figsize=myfigsize)
-#plt.plot(df_afstanden_w['inwoners'], df_afstanden_w['dist_mean'], '.', color=mycol, markersize=mymarkersz)
-df_afstanden_w.plot(x='inwoners', y='dist_mean', kind='scatter', color=mycol, s=mymarkersz) #pradeep
-plt.xlim(-1000, 100000)
-plt.ylim(-100,6000)
-plt.xlabel("Aantal inwoners per wijk", labelpad=10, fontdict=fontdict)
-plt.ylabel("Afstand tot stemlokaal (meter)", labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.grid(True, axis='y', color='#EEEEEE', zorder=0)
-
-savefile = "plot_distances_wijk.png"
-plt.savefig(anpath + subwlv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-df_afstanden_w['inwoners'].astype(float).describe()
-df_afstanden_w['dist_mean'].astype(float).describe()
-
-# wijklevel - log
-plt.figure(figsize=myfigsize)
-#plt.loglog(df_afstanden_w['inwoners'], df_afstanden_w['dist_mean'], '.', color=mycol, markersize=mymarkersz)
-#pradeep
-plt.loglog(df_afstanden_w['inwoners'].values, df_afstanden_w['dist_mean'].values, '.', color=mycol, markersize=mymarkersz)
-plt.xlim(1e0,1e6)
-plt.ylim(1e1,1e4)
-plt.xlabel("Aantal inwoners per wijk", labelpad=10, fontdict=fontdict)
-plt.ylabel("Afstand tot stemlokaal (meter)", labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.grid(True, axis='y', color='#EEEEEE', zorder=0)
-
-savefile = "plot_distances_wijk_loglog.png"
-plt.savefig(anpath + subwlv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-# gemeentelevel - regular
-plt.figure(figsize=myfigsize)
-#plt.plot(df_afstanden_g['inwoners'], df_afstanden_g['dist_mean'], '.', color=mycol, markersize=mymarkersz)
-#pradeep
-df_afstanden_g.plot(x='inwoners', y='dist_mean', kind='scatter', color=mycol, s=mymarkersz) #pradeep
-plt.xlim(-20000,900000)
-plt.ylim(150,1200)
-plt.xlabel("Aantal inwoners per gemeente", labelpad=10, fontdict=fontdict)
-plt.ylabel("Afstand tot stemlokaal (meter)", labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.grid(True, axis='y', color='#EEEEEE', zorder=0)
-
-savefile = "plot_distances_gemeente.png"
-plt.savefig(anpath + subglv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-df_afstanden_w['inwoners'].astype(float).describe()
-df_afstanden_w['dist_mean'].astype(float).describe()
-
-# gemeentelevel - log
-plt.figure(figsize=myfigsize)
-#plt.loglog(df_afstanden_g['inwoners'], df_afstanden_g['dist_mean'], '.', color=mycol, markersize=mymarkersz)
-plt.loglog(df_afstanden_g['inwoners'].values, df_afstanden_g['dist_mean'].values, '.', color=mycol, markersize=mymarkersz)
-plt.xlim(0.5e3,2e6)
-plt.ylim(1e2,2e3)
-plt.xlabel("Aantal inwoners per gemeente", labelpad=10, fontdict=fontdict)
-plt.ylabel("Afstand tot stemlokaal (meter)", labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-
-savefile = "plot_distances_gemeente_loglog.png"
-plt.savefig(anpath + subglv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-
-#%% # Plots 2
-dfwimsf_wijk = pd.merge(dfwimsf.rename(columns={'Postcode':'PC6'}), mapgwb_nonum, how='left', on='PC6')
-dfwimsf_wijk_gr = dfwimsf_wijk.groupby('Wijkcode').count().reset_index().rename(columns={'_id':'count_SL'})
-dfwimsf_wijk_gr = dfwimsf_wijk_gr[['Wijkcode','count_SL']]
-
-# change same types
-dfwimsf_wijk_gr['Wijkcode'] = dfwimsf_wijk_gr['Wijkcode'].astype(int)
-dfkwbw['Wijkcode'] = dfkwbw['Wijkcode'].astype(int)
-
-# merge
-dfkwbsl = pd.merge(dfkwbw, dfwimsf_wijk_gr, how='left', on='Wijkcode')
-dfkwbsl.isna().sum()
-dfkwbsl = dfkwbsl.dropna().drop(columns=['recs'])
-
-mycol = '#3f88c5' #'navy'
-myfontsize = 15
-tickfontsize = 15
-mymarkersz = 7 # default = 6
-myfigsize = (10,5) # default = 8,6
-plt.rcParams['axes.formatter.min_exponent'] = 5 # default = 0
-plt.rcParams['xtick.labelsize'] = tickfontsize
-
-normalized_count = dfkwbsl['count_SL']/dfkwbsl['a_inw']*1000
-
-# inkomen/SL wijklevel - log
-plt.figure(figsize=myfigsize)
-#plt.loglog(dfkwbsl['g_ink_pi'], normalized_count, '.', color=mycol, markersize=mymarkersz)
-#pradeep
-g_ink_pi_array = np.array(dfkwbsl['g_ink_pi'].values)
-plt.loglog(g_ink_pi_array, np.array(normalized_count), '.', color=mycol, markersize=mymarkersz)
-plt.xlim(1e1,1e2)
-plt.ylim(1e-2,1e1)
-plt.xlabel('Gemiddeld inkomen per wijk (x 1000 euro)', labelpad=10, fontdict=fontdict)
-plt.ylabel('Aantal stemlokalen per 1000 inwoners', labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.grid(True, axis='y', color='#EEEEEE', zorder=0)
-
-savefile = "plot_inkomen_SL_wijk_loglog.png"
-plt.savefig(anpath + subwlv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-# inkomen/afstand wijklevel - log
-plt.figure(figsize=myfigsize)
-#plt.loglog(df_afstanden_w_['g_ink_pi'], df_afstanden_w_['dist_mean'], '.', color=mycol, markersize=mymarkersz)
-#pradeep
-plt.loglog(df_afstanden_w_['g_ink_pi'].values, df_afstanden_w_['dist_mean'].values, '.', color=mycol, markersize=mymarkersz)
-plt.xlim(1e1,1e2)
-plt.ylim(2e1,5e3)
-plt.xlabel('Gemiddeld inkomen per wijk (x 1000 euro)', labelpad=10, fontdict=fontdict)
-plt.ylabel('Afstand tot stemlokaal (meter)', labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.grid(True, axis='y', color='#EEEEEE', zorder=0)
-
-savefile = "plot_inkomen_afstand_wijk_loglog.png"
-plt.savefig(anpath + subwlv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-# woningwaarde/SL wijklevel - log
-plt.figure(figsize=myfigsize)
-#plt.loglog(dfkwbsl['g_wozbag'], normalized_count, '.', color=mycol, markersize=mymarkersz)
-#pradeep
-g_wozbag_array = np.array(dfkwbsl['g_wozbag'].values)
-plt.loglog(g_wozbag_array, np.array(normalized_count), '.', color=mycol, markersize=mymarkersz)
-plt.xlim(5e1,2e3)
-plt.ylim(1e-2,1e2)
-plt.xlabel('Gemiddelde WOZ-waarde per wijk (x 1000 euro)', labelpad=10, fontsize=myfontsize)
-plt.ylabel('Aantal stemlokalen per 1000 inwoners', labelpad=10, fontsize=myfontsize)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.grid(True, axis='y', color='#EEEEEE', zorder=0)
-
-savefile = "plot_woningwaarde_SL_wijk_loglog.png"
-plt.savefig(anpath + subwlv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
-# inkomen/afstand wijklevel - log
-plt.figure(figsize=myfigsize)
-plt.loglog(df_afstanden_w_['g_wozbag'].values, df_afstanden_w_['dist_mean'].values, '.', color=mycol, markersize=mymarkersz)
-plt.xlim(5e1,2e3)
-plt.ylim(1e1,1e4)
-plt.xlabel('Gemiddelde WOZ-waarde per wijk (x 1000 euro)', labelpad=10, fontdict=fontdict)
-plt.ylabel('Afstand tot stemlokaal (meter)', labelpad=10, fontdict=fontdict)
-plt.xticks(fontsize=tickfontsize)
-plt.yticks(fontsize=tickfontsize)
-plt.grid(True, axis='y', color='#EEEEEE', zorder=0)
-
-savefile = "plot_woningwaarde_afstand_wijk_loglog.png"
-plt.savefig(anpath + subwlv + savefile, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=mydpi)
-plt.show()
-plt.close()
-
+# the figures of the report, drawn by plot_figure (plot_functions.py) from a table of stage_plot
+labels_sl = {'ylabel': 'Aantal stemlokalen per 1000 inwoners'}
+labels_afstand = {'ylabel': 'Afstand tot stemlokaal (meter)'}
+figures = [
+    # histogram (number of boxes with more than 5 inhabitants per distance bin of the cube)
+    {'file': 'plot_distances_histogram_alteast_5_pop.png', 'subdir': None, 'data': 'histogram', 'kind': 'hist',
+     'x': 'afstand', 'weights': 'gebieden', 'bins': 10, 'range': [0,3000], 'tight_layout': True,
+     'xlabel': 'Afstand (meter)', 'ylabel': 'Aantal gebieden'},
+    # wijklevel - regular and log
+    {'file': 'plot_distances_wijk.png', 'subdir': 'subwlv', 'data': 'df_afstanden_w', 'kind': 'scatter', 'x': 'inwoners', 'y': 'dist_mean',
+     'xlim': (-1000,100000), 'ylim': (-100,6000), 'grid': True, 'xlabel': 'Aantal inwoners per wijk', **labels_afstand},
+    {'file': 'plot_distances_wijk_loglog.png', 'subdir': 'subwlv', 'data': 'df_afstanden_w', 'kind': 'loglog', 'x': 'inwoners', 'y': 'dist_mean',
+     'xlim': (1e0,1e6), 'ylim': (1e1,1e4), 'grid': True, 'xlabel': 'Aantal inwoners per wijk', **labels_afstand},
+    # gemeentelevel - regular and log
+    {'file': 'plot_distances_gemeente.png', 'subdir': 'subglv', 'data': 'df_afstanden_g', 'kind': 'scatter', 'x': 'inwoners', 'y': 'dist_mean',
+     'xlim': (-20000,900000), 'ylim': (150,1200), 'grid': True, 'xlabel': 'Aantal inwoners per gemeente', **labels_afstand},
+    {'file': 'plot_distances_gemeente_loglog.png', 'subdir': 'subglv', 'data': 'df_afstanden_g', 'kind': 'loglog', 'x': 'inwoners', 'y': 'dist_mean',
+     'xlim': (0.5e3,2e6), 'ylim': (1e2,2e3), 'xlabel': 'Aantal inwoners per gemeente', **labels_afstand},
+    # inkomen/SL and inkomen/afstand wijklevel - log
+    {'file': 'plot_inkomen_SL_wijk_loglog.png', 'subdir': 'subwlv', 'data': 'dfkwbsl', 'kind': 'loglog', 'x': 'g_ink_pi', 'y': 'count_SL_1000',
+     'xlim': (1e1,1e2), 'ylim': (1e-2,1e1), 'grid': True, 'xlabel': 'Gemiddeld inkomen per wijk (x 1000 euro)', **labels_sl},
+    {'file': 'plot_inkomen_afstand_wijk_loglog.png', 'subdir': 'subwlv', 'data': 'df_afstanden_w_', 'kind': 'loglog', 'x': 'g_ink_pi', 'y': 'dist_mean',
+     'xlim': (1e1,1e2), 'ylim': (2e1,5e3), 'grid': True, 'xlabel': 'Gemiddeld inkomen per wijk (x 1000 euro)', **labels_afstand},
+    # woningwaarde/SL and woningwaarde/afstand wijklevel - log
+    {'file': 'plot_woningwaarde_SL_wijk_loglog.png', 'subdir': 'subwlv', 'data': 'dfkwbsl', 'kind': 'loglog', 'x': 'g_wozbag', 'y': 'count_SL_1000',
+     'xlim': (5e1,2e3), 'ylim': (1e-2,1e2), 'grid': True, 'xlabel': 'Gemiddelde WOZ-waarde per wijk (x 1000 euro)', **labels_sl,
+     'labelkw': {'fontsize': 15}},
+    {'file': 'plot_woningwaarde_afstand_wijk_loglog.png', 'subdir': 'subwlv', 'data': 'df_afstanden_w_', 'kind': 'loglog', 'x': 'g_wozbag', 'y': 'dist_mean',
+     'xlim': (5e1,2e3), 'ylim': (1e1,1e4), 'grid': True, 'xlabel': 'Gemiddelde WOZ-waarde per wijk (x 1000 euro)', **labels_afstand},
+    ]
+
+def stage_plot(cfg, state):
+    dist_cube, dfwimsf, dfkwbw, pc6index = state['dist_cube'], state['dfwimsf'], state['dfkwbw'], state['pc6index']
+
+    # histogram (number of boxes with more than 5 inhabitants per bar), the distance bins of the cube summed per
+    # bar, so every bar has to start and end on an edge of the cube
+    spec = next(spec for spec in figures if spec['data'] == 'histogram')
+    bars, edges = np.linspace(*spec['range'], spec['bins'] + 1), dist_cube['edges']
+    if not np.isin(bars, edges).all():
+        raise ValueError('The histogram bars %s are not on the edges of the distance cube, see cube_bin_width and cube_max_distance' % bars.tolist())
+    gebieden = dist_cube['gebieden'].sum(axis=0)
+    counts = [gebieden[(edges[:-1] >= low) & (edges[1:] <= high)].sum() for low, high in zip(bars[:-1], bars[1:])]
+    histogram = pd.DataFrame({'afstand': (bars[:-1] + bars[1:])/2, 'gebieden': counts})
+
+    if cfg['verbose'] > 1:
+        print(state['df_afstanden_w']['inwoners'].astype(float).describe())
+        print(state['df_afstanden_w']['dist_mean'].astype(float).describe())
+
+    # plots 2
+    dfwimsf_wijk = dfwimsf[['_id']].join( lookup_pc6(pc6index, dfwimsf['Postcode'])['Wijkcode'] )
+    dfwimsf_wijk_gr = dfwimsf_wijk.groupby('Wijkcode').count().reset_index().rename(columns={'_id':'count_SL'})
+    dfwimsf_wijk_gr = dfwimsf_wijk_gr[['Wijkcode','count_SL']]
+
+    # change same types
+    dfwimsf_wijk_gr['Wijkcode'] = dfwimsf_wijk_gr['Wijkcode'].astype(int)
+    dfkwbw = dfkwbw.copy()
+    dfkwbw['Wijkcode'] = dfkwbw['Wijkcode'].astype(int)
+
+    # merge
+    dfkwbsl = pd.merge(dfkwbw, dfwimsf_wijk_gr, how='left', on='Wijkcode')
+    dfkwbsl = dfkwbsl.dropna().drop(columns=['recs'])
+    dfkwbsl['count_SL_1000'] = dfkwbsl['count_SL']/dfkwbsl['a_inw']*1000 # normalized count
+
+    # per figure only its own columns, with a key of those, the spec and the dpi: unchanged figures are skipped
+    tables = {'histogram': histogram, 'df_afstanden_g': state['df_afstanden_g'], 'df_afstanden_w': state['df_afstanden_w'],
+              'df_afstanden_w_': state['df_afstanden_w_'], 'dfkwbsl': dfkwbsl}
+    dpi = cfg['preview_dpi'] if cfg['plot_preview'] else cfg['mydpi']
+    keysfile = os.path.join(cfg['cachepath'], 'checkpoints', 'plot_keys.pkl')
+    keep_keys = cfg['do_use_checkpoints'] and not cfg['do_refresh_checkpoints'] and not cfg['show_plots']
+    plot_keys = (load_checkpoint(keysfile) if keep_keys else None) or {}
+    jobs = []
+    for spec in figures:
+        filename = os.path.join(cfg['anpath'], cfg[spec['subdir']] if spec['subdir'] else '', spec['file'])
+        if cfg['plot_preview']:
+            filename = '%s_preview%s' % os.path.splitext(filename)
+        data = tables[spec['data']][[spec[col] for col in ['x','y','weights'] if col in spec]].reset_index(drop=True)
+        data_key = hashlib.md5(pd.util.hash_pandas_object(data).to_numpy().tobytes()).hexdigest()
+        key = files_key([], spec, dpi, data_key, inspect.getsource(plot_figure))
+        if keep_keys and (plot_keys.get(filename) == key) and os.path.exists(filename):
+            continue
+        jobs.append((spec, data, filename, key))
+
+    # with show_plots one by one on screen, otherwise off screen in worker processes
+    workers = os.cpu_count() if cfg['plot_workers'] == -1 else cfg['plot_workers']
+    if cfg['show_plots'] or (workers <= 1) or (len(jobs) <= 1):
+        for spec, data, filename, key in jobs:
+            plot_figure(spec, data, filename, dpi=dpi, show=cfg['show_plots'])
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            list(pool.map(plot_figure, *zip(*[(spec, data, filename, dpi) for spec, data, filename, key in jobs])))
+    plot_keys.update({filename: key for spec, data, filename, key in jobs})
+    if cfg['do_use_checkpoints']:
+        save_checkpoint(plot_keys, keysfile)
+    if cfg['verbose']:
+        print('Figures drawn = %d, unchanged = %d (dpi %d)' % (len(jobs), len(figures)-len(jobs), dpi))
+
+    return {}
+
+
+#%% # Pipeline
+# name: (function, inputs from the state, outputs, settings it depends on), in order of execution
+stages = {'read':      (stage_read,      [],
+                        ['dfwimso','dfwimsf','gdfbox','gdfpc6','dfkwbs','mapgem23','mapgem','mapwyk','pc6index'],
+                        ['kwb_years','map_years','do_stream']),
+          'clean':     (stage_clean,     ['dfwimso','dfwimsf','gdfbox','gdfpc6','dfkwbs','mapgem23','mapwyk','pc6index'],
+                        ['dfwimso','dfwimsf','dfwimsf_near','gdfbox','gdfpc6','dfkwbw','mapgem23','mapwyk','pc6index'],
+                        ['kwb_years','map_years','do_check_again','do_check_fuzzy','fuzzy_radius','fuzzy_min_score','do_new_features','geocoder']),
+          'nearest':   (stage_nearest,   ['gdfbox','dfwimsf'], ['gdfboxn'], ['nearest_method','k_nearest','do_benchmark']),
+          'distances': (stage_distances, ['gdfboxn','dfwimsf'], ['gdfboxn'], ['do_benchmark']),
+          'aggregate': (stage_aggregate, ['gdfboxn','mapgem23','mapwyk','pc6index','dfkwbw'],
+                        ['df_afstanden_g','df_afstanden_w','df_afstanden_w_','dist_cube'],
+                        ['dist_quantiles','cube_bin_width','cube_max_distance']),
+          'stream':    (stage_stream,    ['dfwimsf','gdfpc6','mapgem23','mapwyk','pc6index','dfkwbw'],
+                        ['df_afstanden_g','df_afstanden_w','df_afstanden_w_','dist_cube'],
+                        ['grid','nearest_method','dist_quantiles','cube_bin_width','cube_max_distance']),
+          'compare':   (stage_compare,   ['gdfbox','dfwimso','dfwimsf'], ['df_compare_g','df_compare_w'], ['elections','nearest_method']),
+          'save':      (stage_save,      ['df_afstanden_g','df_afstanden_w','dist_cube','dfwimsf_near'], [], []),
+          'plot':      (stage_plot,      ['dist_cube','dfwimsf','dfkwbw','pc6index','df_afstanden_g','df_afstanden_w','df_afstanden_w_'],
+                        [], [])}
+checkpoint_stages = ['clean','nearest','distances','aggregate','stream','compare'] # read has the columnar cache
+stream_stages = ['nearest','distances','aggregate'] # replaced by stream with do_stream
+# the helpers (functions or module constants) that a stage function uses, directly or through other helpers: their
+# source is part of the key of the stage, see code_key
+helpers_nearest = [find_nearest, rank_order, query_ordered, find_k_nearest]
+helpers_network = [read_network, load_network, network_graph, network_distances, find_nearest_network]
+stage_helpers = {'read':      [read_cached, read_grid, iter_grid, representative_xy, merge_vintages, read_mapping_gwb, csv_delimiter,
+                               build_pc6_index, save_pc6_index, load_pc6_index, cols_rename_mapping, readsettings_mapping, cols_box],
+                 'clean':     [check_duplicates, find_near_duplicates, select_wims, merge_vintages, read_mapping_gwb, csv_delimiter, geocode,
+                               representative_xy, remote_geocoder, lookup_pc6, lookup_sorted, prepare_boxes, cols_rename_mapping],
+                 'nearest':   [find_nearest_incremental, update_nearest, closer_to_added] + helpers_nearest + helpers_network,
+                 'distances': [find_distances, find_distances_loop, weighted_average, weighted_median],
+                 'aggregate': [aggregate_distances, weighted_quantiles, distance_cube, organize_afstanden],
+                 'stream':    [iter_grid, representative_xy, prepare_boxes, nearest_stemlokalen, distance_sums, distance_cube, add_cubes,
+                               distance_table, cube_table, organize_afstanden, cols_box] + helpers_nearest + helpers_network,
+                 'compare':   [read_cached, select_wims, nearest_stemlokalen, level_distances, weighted_quantiles, compare_distances,
+                               weighted_average] + helpers_nearest + helpers_network,
+                 'save':      [],
+                 'plot':      [lookup_pc6, lookup_sorted, plot_figure, figures]}
+
+def pipeline_stages(cfg):
+    # the stages of a full run: with do_stream the stream stage instead of nearest, distances and aggregate, and
+    # compare only with elections
+    skip = stream_stages if cfg['do_stream'] else ['stream']
+    skip = skip + ([] if cfg['elections'] else ['compare'])
+    return [name for name in stages if name not in skip]
+
+def stage_inputs(cfg, name):
+    # inputs of a stage from the state: with elections the save stage also writes the compare tables
+    inputs = stages[name][1]
+    return inputs + ['df_compare_g','df_compare_w'] if (name == 'save' and cfg['elections']) else inputs
+
+def code_key(name):
+    # hash of the source of a stage function and of its helpers (stage_helpers), so a change in a helper (e.g.
+    # prepare_boxes, find_nearest or aggregate_distances) gives new checkpoints, but a change in a later stage (e.g.
+    # stage_plot or the figures) leaves the checkpoints of the earlier stages as they are
+    parts = [stages[name][0]] + stage_helpers[name]
+    return hashlib.md5(''.join(inspect.getsource(part) if callable(part) else repr(part) for part in parts).encode()).hexdigest()
+
+def stage_keys(cfg):
+    # content address of the outputs of every stage: a hash of the code, its settings and the keys of the
+    # stages its inputs come from, with the files it reads itself (path, modification time, size)
+    keys, producers = {}, {}
+    for name, (stage, inputs, outputs, params) in stages.items():
+        filenames = {'read': input_files(cfg), 'nearest': network_files(cfg), 'stream': [grid_file(cfg)] + network_files(cfg),
+                     'compare': election_files(cfg) + network_files(cfg)}.get(name, [])
+        input_keys = [producers[key] for key in stage_inputs(cfg, name)]
+        keys[name] = files_key(filenames, name, code_key(name), [cfg[param] for param in params], input_keys)
+        producers.update({output: keys[name] for output in outputs})
+    return keys
+
+def checkpoint_file(cfg, name, key):
+    return os.path.join(cfg['cachepath'], 'checkpoints', '%s_%s.pkl' % (name, key))
+
+class PlanError(Exception):
+    # the chosen stages cannot run: outputs of stages that were not chosen and have no checkpoint are needed
+    pass
+
+def plan_pipeline(cfg, stages_to_run, state):
+    # what to do per stage: 'run' or 'load' (from its checkpoint). Working back from the last stage, a
+    # chosen stage is loaded if it has a checkpoint, otherwise run; a stage that is not chosen is only
+    # loaded when a later stage needs its outputs. A chosen stage whose outputs are not needed any more is
+    # left out, unless it is the last chosen one, only makes files (save, plot) or has no checkpoint yet (so
+    # it is there next time). Stages outside pipeline_stages are only used when chosen.
+    keys = stage_keys(cfg)
+    use_checkpoints = cfg['do_use_checkpoints']
+    last = [name for name in stages if name in stages_to_run][-1:]
+    plan, needed = {}, set()
+    for name in reversed(list(stages)):
+        stage, inputs, outputs, params = stages[name]
+        if (name not in stages_to_run) and (name not in pipeline_stages(cfg)):
+            continue
+        provides = needed.intersection(outputs)
+        stored = use_checkpoints and (name in checkpoint_stages) and os.path.exists(checkpoint_file(cfg, name, keys[name]))
+        fresh = stored and not cfg['do_refresh_checkpoints']
+        chosen = (name in stages_to_run) and (provides or name in last or not outputs or (name in checkpoint_stages and not fresh))
+        if chosen and fresh:
+            plan[name] = 'load'
+        elif chosen:
+            plan[name] = 'run'
+        elif stored and provides:
+            plan[name] = 'load'
+        elif provides:
+            raise PlanError("Stage '%s' is needed for %s; run it as well" % (name, ', '.join(sorted(provides))))
+        else:
+            continue
+        needed -= set(outputs)
+        if plan[name] == 'run':
+            needed |= set(stage_inputs(cfg, name)) - set(state)
+    if needed:
+        raise PlanError("Missing %s; run the earlier stages as well" % ', '.join(sorted(needed)))
+    return {name: plan[name] for name in stages if name in plan}, keys
+
+def peak_memory():
+    # peak resident memory of this process so far in MB, None where there is no resource module (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, kB on Linux
+
+def run_pipeline(cfg, stages_to_run=None, state=None):
+    # run the chosen stages (default all, see pipeline_stages) in pipeline order, each on the state left by the
+    # ones before, taking the outputs of a stage from its checkpoint where possible
+    state = {} if state is None else state
+    stages_to_run = pipeline_stages(cfg) if stages_to_run is None else stages_to_run
+    plan, keys = plan_pipeline(cfg, stages_to_run, state)
+    for name, action in plan.items():
+        stage, inputs, outputs, params = stages[name]
+        filename = checkpoint_file(cfg, name, keys[name])
+        t0 = time.perf_counter()
+        if action == 'load':
+            state.update( load_checkpoint(filename) )
+        else:
+            state.update( stage(cfg, state) )
+            if cfg['do_use_checkpoints'] and (name in checkpoint_stages):
+                save_checkpoint({output: state[output] for output in outputs}, filename)
+        if cfg['verbose']:
+            memory = '' if peak_memory() is None else ', peak memory %.0f MB' % peak_memory()
+            print('Stage %s %s in %.1f s%s' % (name, 'loaded from checkpoint' if action == 'load' else 'done', time.perf_counter()-t0, memory))
+    return state
+
+def load_scenario_base(cfg):
+    # baseline for scenario_distances/scenario_batch (what if stemlokalen open or close) from the boxes with their
+    # nearest stemlokaal of the distances stage, mostly from the checkpoints
+    if cfg['do_stream'] or cfg['nearest_method'] not in [1, 2]:
+        raise ValueError('Scenarios need nearest_method 1 or 2 without do_stream')
+    state = run_pipeline(cfg, ['read','clean'])
+    state = run_pipeline(cfg, ['nearest','distances'], state)
+    return scenario_base(state['gdfboxn'], state['dfwimsf'], by='Gemeentecode' if cfg['nearest_method'] == 2 else None)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find distances of citizens to stemlokalen.')
+    parser.add_argument('--config', nargs='+', default=[], help='ini file(s) read on top of config.ini')
+    parser.add_argument('--stages', nargs='+', choices=list(stages), help='stages to run (default: all, see do_stream)')
+    parser.add_argument('--skip', nargs='+', choices=list(stages), default=[], help='stages to skip')
+    parser.add_argument('--set', nargs='+', default=[], metavar='KEY=VALUE', help='override a config value')
+    args = parser.parse_args(argv)
+
+    overrides = dict(item.split('=', 1) for item in args.set)
+    cfg = load_config(args.config, overrides)
+    stages_to_run = [name for name in (args.stages or pipeline_stages(cfg)) if name not in args.skip]
+    try:
+        run_pipeline(cfg, stages_to_run)
+    except PlanError as error:
+        sys.exit(str(error))
 
-#%% # END
 
+if __name__ == '__main__':
+    main()
 
 
+#%% # END
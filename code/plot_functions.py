@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for the figures of finding_distances.py: one figure from a spec (see figures in finding_distances.py)
+in the style of the report. A figure only needs its spec and its own columns, so the figures can be drawn in
+separate worker processes.
+"""
+
+
+#%% # Libraries
+import os
+
+
+#%% # Style
+mycol = '#3f88c5' #'navy'
+tickfontsize = 15
+mymarkersz = 7 # default = 6
+myfigsize = (10,5) # default = 8,6
+
+fontdict = {
+    'fontname': "Corbel",
+    'fontsize': 15
+}
+
+
+#%% # Functions
+def plot_figure(spec, data, filename, dpi=500, show=False):
+    # draw one figure and save it to filename. The spec gives the kind ('hist', 'scatter' or 'loglog'), the columns
+    # x and y (or weights) of 'data', the labels and optionally xlim/ylim, bins/range, grid, tight_layout and
+    # labelkw (keywords of the axis labels, default the report font). Without show matplotlib draws off screen.
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.rcParams['axes.formatter.min_exponent'] = 5 # default = 0
+
+    fig, ax = plt.subplots(figsize=myfigsize)
+    x = data[spec['x']].to_numpy(dtype=float)
+    if spec['kind'] == 'hist':
+        ax.hist(x, bins=spec['bins'], range=spec['range'], weights=data[spec['weights']].to_numpy(dtype=float), alpha=0.9, rwidth=0.85, color=mycol)
+    elif spec['kind'] == 'scatter':
+        ax.scatter(x, data[spec['y']].to_numpy(dtype=float), color=mycol, s=mymarkersz)
+    elif spec['kind'] == 'loglog':
+        ax.loglog(x, data[spec['y']].to_numpy(dtype=float), '.', color=mycol, markersize=mymarkersz)
+    else:
+        raise ValueError("Unknown kind of figure '%s'" % spec['kind'])
+    if 'xlim' in spec:
+        ax.set_xlim(spec['xlim'])
+    if 'ylim' in spec:
+        ax.set_ylim(spec['ylim'])
+    labelkw = spec.get('labelkw', {'fontdict': fontdict})
+    ax.set_xlabel(spec['xlabel'], labelpad=10, **labelkw)
+    ax.set_ylabel(spec['ylabel'], labelpad=10, **labelkw)
+    ax.tick_params(labelsize=tickfontsize)
+    if spec.get('grid'):
+        ax.grid(True, axis='y', color='#EEEEEE', zorder=0)
+    if spec.get('tight_layout'):
+        fig.tight_layout()
+
+    fig.savefig(filename, bbox_inches='tight', transparent=True, pad_inches=0.2, dpi=dpi)
+    if show:
+        plt.show()
+    plt.close(fig)
+    return os.path.basename(filename)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of distance_functions.py on small hand-made cases: python -m pytest code
+"""
+
+
+#%% # Libraries
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString
+from distance_functions import find_nearest, find_k_nearest, scenario_base, scenario_distances
+from distance_functions import network_graph, network_distances, find_nearest_network
+
+
+#%% # Checks
+def test_ties_use_up_tree():
+    # a box exactly between the only two stemlokalen: all of the tree ties, the lowest _id wins
+    sl = pd.DataFrame({'X': [0., 1000.], 'Y': [0., 0.], '_id': [2, 1], 'Gemeente': ['a','b'], 'Gemeentecode': [1, 2]})
+    box = pd.DataFrame({'X': [500.], 'Y': [0.], 'Gemeentecode': [1]})
+    assert find_nearest(box, sl, col_id='_id')['index_right'].tolist() == [1]
+    assert find_nearest(box, sl, by='Gemeentecode', col_id='_id')['index_right'].tolist() == [0]
+    nearest = find_k_nearest(box, sl, k=2, col_id='_id')
+    assert nearest[['index_right_1','index_right_2']].values.tolist() == [[1, 0]]
+
+def test_scenario_adds_tied_stemlokalen():
+    # two added stemlokalen at the same distance of a box (closer_to_added on a tree of two points)
+    sl = pd.DataFrame({'X': [0.], 'Y': [0.], '_id': [1], 'Gemeente': ['a'], 'Gemeentecode': [1]})
+    boxes = pd.DataFrame({'X': [500., 5000.], 'Y': [0., 0.], 'Gemeentecode': [1, 1], 'Wijkcode': [10, 10], 'aantal_inwoners': [100, 100]})
+    boxes = boxes.join(find_nearest(boxes, sl, col_id='_id'))
+    base = scenario_base(boxes, sl)
+    add = pd.DataFrame({'X': [4000., 6000.], 'Y': [0., 0.], '_id': [2, 3], 'Gemeente': ['a','a'], 'Gemeentecode': [1, 1]})
+    output = scenario_distances(base, add=add)
+    wijk = output[output['level'] == 'Wijkcode'].iloc[0]
+    assert wijk['dist_mean'] == 750.
+
+def test_scenario_code_loses_all_boxes():
+    # closing the only stemlokaal of gemeente 1: its row is still there, with 0 inhabitants after
+    sl = pd.DataFrame({'X': [0., 3000.], 'Y': [0., 0.], '_id': [1, 2], 'Gemeente': ['a','b'], 'Gemeentecode': [1, 2]})
+    boxes = pd.DataFrame({'X': [100., 2900.], 'Y': [0., 0.], 'Gemeentecode': [1, 2], 'Wijkcode': [10, 20], 'aantal_inwoners': [20000, 100]})
+    boxes = boxes.join(find_nearest(boxes, sl, col_id='_id'))
+    output = scenario_distances(scenario_base(boxes, sl), remove=[1]).set_index(['level','code'])
+    gemeente = output.loc[('Gemeentecode_nearest_SL', 1)]
+    assert (gemeente['inwoners'], gemeente['inwoners_base']) == (0, 20000)
+    assert pd.isna(gemeente['dist_mean']) and gemeente['dist_mean_base'] == 100.
+    assert output.loc[('Gemeentecode_nearest_SL', 2), 'inwoners'] == 20100
+
+def test_network_crossing_at_vertex():
+    # a north-south road crossing an east-west road at its middle vertex (500,0): connected there
+    lines = gpd.GeoDataFrame(geometry=[LineString([(0,0),(500,0),(1000,0)]), LineString([(500,-1000),(500,0),(500,1000)])])
+    network = network_graph(lines)
+    sl = pd.DataFrame({'X': [0.], 'Y': [0.], 'Gemeente': ['a'], 'Gemeentecode': [1]})
+    box = pd.DataFrame({'X': [500.], 'Y': [400.]})
+    assert find_nearest_network(box, sl, network_distances(network, sl))['distance_nearest_SL'].tolist() == [900.]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the pipeline of finding_distances.py on empty files: python -m pytest code
+"""
+
+
+#%% # Libraries
+import os
+import finding_distances
+from finding_distances import load_config, input_files, stage_keys, checkpoint_file, pipeline_stages, plan_pipeline
+
+
+#%% # Checks
+def make_files(tmp_path, checkpoints, **overrides):
+    # config on empty input files in tmp_path, with empty checkpoint files of the given stages
+    cfg = load_config(overrides={'mypath': str(tmp_path), 'cachepath': str(tmp_path / 'Cache'), **overrides})
+    for filename in input_files(cfg):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        open(filename, 'w').close()
+    keys = stage_keys(cfg)
+    os.makedirs(tmp_path / 'Cache' / 'checkpoints', exist_ok=True)
+    for name in checkpoints:
+        open(checkpoint_file(cfg, name, keys[name]), 'w').close()
+    return cfg
+
+def test_rerun_after_failing_plot(tmp_path):
+    # all checkpoints are there: only save and plot run, on what they need from the checkpoints
+    cfg = make_files(tmp_path, ['clean','nearest','distances','aggregate'])
+    plan, _ = plan_pipeline(cfg, pipeline_stages(cfg), {})
+    assert plan == {'clean': 'load', 'aggregate': 'load', 'save': 'run', 'plot': 'run'}
+
+def test_plan_with_elections(tmp_path):
+    # with elections the compare tables go to save; without checkpoints every chosen stage runs
+    cfg = make_files(tmp_path, ['clean','nearest','distances','aggregate','compare'], elections="{'a': 'dfwimso', 'b': 'dfwimsf'}")
+    plan, _ = plan_pipeline(cfg, pipeline_stages(cfg), {})
+    assert plan == {'clean': 'load', 'aggregate': 'load', 'compare': 'load', 'save': 'run', 'plot': 'run'}
+    assert plan_pipeline(cfg, ['compare','save'], {})[0] == {'clean': 'load', 'aggregate': 'load', 'compare': 'load', 'save': 'run'}
+    cfg['do_use_checkpoints'] = 0
+    plan, _ = plan_pipeline(cfg, [name for name in pipeline_stages(cfg) if name not in ['save','plot']], {})
+    assert list(plan) == ['read','clean','nearest','distances','aggregate','compare']
+    assert set(plan.values()) == {'run'}
+
+def test_plot_change_keeps_checkpoints(tmp_path, monkeypatch):
+    # other figures only give a new key of plot, another helper of clean new keys from clean on
+    cfg = make_files(tmp_path, [])
+    keys = stage_keys(cfg)
+    monkeypatch.setitem(finding_distances.stage_helpers, 'plot', finding_distances.stage_helpers['plot'] + [{'file': 'other.png'}])
+    changed = stage_keys(cfg)
+    assert [name for name in keys if keys[name] != changed[name]] == ['plot']
+    monkeypatch.setitem(finding_distances.stage_helpers, 'clean', finding_distances.stage_helpers['clean'] + [{'other': 1}])
+    changed = stage_keys(cfg)
+    assert [name for name in keys if keys[name] != changed[name]] == ['clean','nearest','distances','aggregate','stream','compare','save','plot']